@@ -1,8 +1,35 @@
+import hashlib
+import json
 import os
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 
 import appdirs
+import click
 
-from ._helpers import call_cmd, mkdir_p
+from ._helpers import DEFAULT_JOBS, NotAGitURL, call_cmd, mkdir_p, parse_git_url
+
+try:
+    import fcntl
+except ImportError:  # Windows, go without locking
+    fcntl = None
+
+ALL_BRANCHES = "refs/heads/*:refs/heads/*"
+# Fetch only the branches needed (and later requested) or all into caches
+CACHE_MODES = ("branch", "all")
+LOCK_FILE = "odooup.lock"
+STATE_FILE = "odooup.json"
+# Default freshness window (seconds) of cached repos for cloning
+CACHE_MAX_AGE = 300
+
+
+def get_cache_dir(*parts):
+    """get a path inside odooup's user cache directory"""
+    return os.path.join(appdirs.user_cache_dir("odooup"), *parts)
 
 
 def construe_git_url(prefix, host, org, project):
@@ -11,19 +38,319 @@ def construe_git_url(prefix, host, org, project):
     return prefix + host + sep + org + "/" + project  # + '.git'
 
 
-def cache_repo(prefix, host, org, project):
-    """ Cache repo locally (or update cache) """
+@contextmanager
+def _repo_lock(repo_cache_dir):
+    """ Hold an advisory lock on a cached repo (no-op where fcntl is missing) """
+    mkdir_p(repo_cache_dir)
+    with open(os.path.join(repo_cache_dir, LOCK_FILE), "a") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_state(repo_cache_dir):
+    try:
+        with open(os.path.join(repo_cache_dir, STATE_FILE), "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_state(repo_cache_dir, state):
+    with open(os.path.join(repo_cache_dir, STATE_FILE), "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+def _get_refspec(branch):
+    return "+refs/heads/{branch}:refs/heads/{branch}".format(branch=branch)
+
+
+def cache_repo(
+    prefix,
+    host,
+    org,
+    project,
+    echo_cmd=True,
+    raise_on_error=False,
+    max_age=0,
+    branches=None,
+    mark_used=False,
+):
+    """ Cache repo locally (or update cache)
+
+    Concurrent odooup processes serialize on a per repo file lock. Fetching is
+    skipped if the cache was refreshed less than max_age seconds ago. With
+    branches, only those are fetched: the cache grows by branch on demand.
+    Only with mark_used, the cache is recorded as used (for cloning).
+    """
     # init cache directory
 
-    cache_dir = appdirs.user_cache_dir("odooup")
-    repo_cache_dir = os.path.join(cache_dir, host, org.lower(), project.lower())
-
-    if not os.path.isdir(repo_cache_dir):
-        mkdir_p(repo_cache_dir)
-        cmd = ["git", "init", "--bare"]
-        call_cmd(" ".join(cmd), echo_cmd=False, exit_on_error=True, cwd=repo_cache_dir)
-    repo_url = construe_git_url(prefix, host, org, project)
-    # fetch all branches into cache
-    cmd = ["git", "fetch", "--quiet", "--force", repo_url, "refs/heads/*:refs/heads/*"]
-    call_cmd(" ".join(cmd), echo_cmd=True, exit_on_error=True, cwd=repo_cache_dir)
+    repo_cache_dir = get_cache_dir(host, org.lower(), project.lower())
+
+    with _repo_lock(repo_cache_dir):
+        if not os.path.isfile(os.path.join(repo_cache_dir, "HEAD")):
+            cmd = ["git", "init", "--bare"]
+            call_cmd(
+                cmd,
+                echo_cmd=False,
+                exit_on_error=True,
+                cwd=repo_cache_dir,
+                raise_on_error=raise_on_error,
+            )
+        repo_url = construe_git_url(prefix, host, org, project)
+        now = time.time()
+        state = _read_state(repo_cache_dir)
+        state["url"] = repo_url
+        if mark_used:
+            state["used"] = now
+        fetched = state.setdefault("fetched", {})
+
+        def _is_fresh(refspec):
+            last_fetch = max(fetched.get(refspec, 0), fetched.get(ALL_BRANCHES, 0))
+            return now - last_fetch < max_age
+
+        if branches:
+            refspecs = [_get_refspec(b) for b in sorted(set(branches))]
+        else:
+            refspecs = [ALL_BRANCHES]
+        refspecs = [r for r in refspecs if not _is_fresh(r)]
+        if not refspecs:
+            _write_state(repo_cache_dir, state)
+            return repo_cache_dir
+        # fetch (the requested or all) branches into cache
+        cmd = ["git", "fetch", "--quiet", "--force", repo_url] + refspecs
+        call_cmd(
+            cmd,
+            echo_cmd=echo_cmd,
+            exit_on_error=True,
+            cwd=repo_cache_dir,
+            raise_on_error=raise_on_error,
+        )
+        for refspec in refspecs:
+            fetched[refspec] = now
+        _write_state(repo_cache_dir, state)
     return repo_cache_dir
+
+
+def cache_repos(urls, max_age=0, jobs=DEFAULT_JOBS, branches=None, mark_used=False):
+    """ Cache (or update) many repos concurrently
+
+    :param branches: optional dict {url: [branch]} to fetch only those
+    :param mark_used: record the repos as used (for cloning)
+    :return: ({url: repo_cache_dir}, {url: error message}) for cached and
+             failed repos respectively
+    """
+    cached = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for url in sorted(set(urls)):
+            try:
+                parts = parse_git_url(url)
+            except NotAGitURL as exc:
+                failures[url] = "{}: {}".format(exc.message, exc.expression)
+                continue
+            future = pool.submit(
+                cache_repo,
+                *parts,
+                echo_cmd=False,
+                raise_on_error=True,
+                max_age=max_age,
+                branches=(branches or {}).get(url),
+                mark_used=mark_used
+            )
+            futures[future] = url
+        for done, future in enumerate(as_completed(futures), 1):
+            url = futures[future]
+            progress = "[{}/{}] Caching {}".format(done, len(futures), url)
+            try:
+                cached[url] = future.result()
+            except subprocess.CalledProcessError as exc:
+                failures[url] = "{}\n{}".format(exc.cmd, str(exc.output).strip())
+                click.secho(progress + " ... failed", fg="red")
+                continue
+            click.secho(progress + " ... done", fg="yellow")
+    return cached, failures
+
+
+def add_borrower(repo_cache_dir, git_dir):
+    """ Record git_dir as borrowing objects from a cached repo (through its
+    alternates), which keeps `prune` from evicting it """
+    with _repo_lock(repo_cache_dir):
+        state = _read_state(repo_cache_dir)
+        borrowers = set(state.get("borrowers", []))
+        borrowers.add(os.path.abspath(git_dir))
+        state["borrowers"] = sorted(borrowers)
+        _write_state(repo_cache_dir, state)
+
+
+def _get_borrowers(repo_cache_dir, state):
+    """ The recorded borrowers whose alternates still point at the cache """
+    objects = os.path.realpath(os.path.join(repo_cache_dir, "objects"))
+    borrowers = []
+    for git_dir in state.get("borrowers", []):
+        alternates_dir = os.path.join(git_dir, "objects")
+        try:
+            with open(os.path.join(alternates_dir, "info", "alternates")) as f:
+                alternates = f.read().splitlines()
+        except (IOError, OSError):  # Removed or dissociated since
+            continue
+        if any(
+            os.path.realpath(os.path.join(alternates_dir, a)) == objects
+            for a in alternates
+        ):
+            borrowers.append(git_dir)
+    return borrowers
+
+
+def get_cache_key(*parts):
+    """derive a stable cache key from (git object ids or other) strings"""
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+def _json_default(obj):
+    # literal_eval'ed manifests may contain sets (or other) non-json types
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    return repr(obj)
+
+
+class JsonCache(object):
+    """ Size bounded on-disk store of json documents keyed by immutable ids
+
+    Entries are sharded by key prefix under the odooup cache directory. Reads
+    refresh an entry's mtime, so that `evict` drops the least recently used
+    entries once the store grows beyond `max_size` bytes.
+    """
+
+    def __init__(self, name, max_size=64 * 1024 * 1024):
+        self.path = get_cache_dir(name)
+        self.max_size = max_size
+
+    def _key_path(self, key):
+        return os.path.join(self.path, key[:2], key + ".json")
+
+    def get(self, key):
+        key_path = self._key_path(key)
+        try:
+            with open(key_path, "r") as f:
+                value = json.load(f)
+            os.utime(key_path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return value
+
+    def set(self, key, value):
+        key_path = self._key_path(key)
+        mkdir_p(os.path.dirname(key_path))
+        # Write atomically, concurrent odooup runs might read the same entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(key_path))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(value, f, default=_json_default)
+            os.rename(tmp_path, key_path)
+        except (IOError, OSError, TypeError, ValueError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def evict(self):
+        """ Remove least recently used entries until under max_size """
+        entries = []
+        total_size = 0
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file_path))
+                total_size += stat.st_size
+        for _, size, file_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(file_path)
+            except OSError:
+                continue
+            total_size -= size
+
+
+def get_cached_repos():
+    """ [repo_cache_dir] of all bare repos in the cache directory """
+    repos = []
+    for root, dirs, files in os.walk(get_cache_dir()):
+        if "HEAD" in files and "objects" in dirs:
+            repos.append(root)
+            dirs[:] = []
+    return sorted(repos)
+
+
+def get_repo_status(repo_cache_dir):
+    """ {url, branches, size, fetched, used, borrowers} of a cached repo
+
+    branches is None if all branches are cached, fetched is the last fetch time
+    and used the last time the repo was cloned from (None if unknown).
+    borrowers are the git dirs still borrowing objects from the repo.
+    """
+    state = _read_state(repo_cache_dir)
+    fetched = state.get("fetched", {})
+    last_fetch = max(fetched.values()) if fetched else None
+    if last_fetch is None:
+        # Caches predating the state file, the last fetch wrote FETCH_HEAD
+        for ref in ("FETCH_HEAD", "HEAD"):
+            try:
+                last_fetch = os.stat(os.path.join(repo_cache_dir, ref)).st_mtime
+                break
+            except OSError:
+                continue
+    branches = None
+    # Caches predating the state file hold all branches
+    if fetched and ALL_BRANCHES not in fetched:
+        branches = sorted(r.split(":")[1][len("refs/heads/") :] for r in fetched)
+    size = 0
+    for root, _, files in os.walk(repo_cache_dir):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                continue
+    return {
+        "url": state.get("url"),
+        "branches": branches,
+        "size": size,
+        "fetched": last_fetch,
+        "used": state.get("used"),
+        "borrowers": _get_borrowers(repo_cache_dir, state),
+    }
+
+
+def optimize_repo(repo_cache_dir, raise_on_error=False):
+    """ Repack a cached repo into a single pack with a reachability bitmap and
+    write its commit-graph, both speed up clones referencing the cache.
+
+    Unreachable objects are kept: projects cloned without --dissociate might
+    still borrow them through their alternates.
+    """
+    with _repo_lock(repo_cache_dir):
+        for cmd in (
+            ["git", "pack-refs", "--all"],
+            ["git", "repack", "-a", "-d", "-q", "-b", "--keep-unreachable"],
+            ["git", "commit-graph", "write", "--reachable"],
+        ):
+            call_cmd(
+                cmd,
+                echo_cmd=False,
+                exit_on_error=True,
+                cwd=repo_cache_dir,
+                raise_on_error=raise_on_error,
+            )
+
+
+def remove_repo(repo_cache_dir):
+    with _repo_lock(repo_cache_dir):
+        shutil.rmtree(repo_cache_dir)
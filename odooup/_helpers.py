@@ -2,28 +2,53 @@
 import errno
 import os
 import re
+import shlex
 import subprocess
 
 import click
 
+from . import _process
+
 REPO_REGEXP = r"(?P<prefix>git@|https://|http://)(?P<host>[\w\.@]{1,})(/|:)(?P<org>[\w,\-,_,/]{1,})/(?P<project>[\w,\-,_]{1,})(.git){0,1}((/){0,1})"  # noqa
 
+# Concurrent git processes, mostly waiting on I/O or the network
+DEFAULT_JOBS = 8
+
+
+def call_cmd(
+    cmd, echo_cmd=True, exit_on_error=True, cwd=None, raise_on_error=False, timeout=None
+):
+    """ Run cmd (an argv list, strings are split shell-like, but no shell is
+    involved) and return its stripped output
 
-def call_cmd(cmd, echo_cmd=True, exit_on_error=True, cwd=None):
+    Failing commands exit the program (exit_on_error), return "ERROR" or, with
+    raise_on_error, raise subprocess.CalledProcessError (eg. in worker threads).
+    Commands running longer than timeout seconds count as failed.
+    """
+    argv = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
     if echo_cmd:
         if cwd:
             click.echo("Do in: " + click.style(cwd, fg="yellow"))
-        click.secho(("\t" if cwd else "") + cmd, fg="green")
-    try:
-        result = subprocess.check_output(
-            cmd, stderr=subprocess.STDOUT, shell=True, universal_newlines=True, cwd=cwd
+        click.secho(
+            ("\t" if cwd else "") + " ".join(shlex.quote(a) for a in argv), fg="green"
         )
+    try:
+        result = _process.run(argv, cwd=cwd, timeout=timeout).output.strip()
+    except subprocess.TimeoutExpired as exc:
+        if raise_on_error:
+            raise
+        if exit_on_error:
+            click.secho(str(exc), fg="red")
+            exit(1)
+        result = "ERROR"
     except subprocess.CalledProcessError as exc:
+        if raise_on_error:
+            raise
         if exit_on_error:
             click.secho(str(exc.output).strip(), fg="red")
             exit(exc.returncode)
         result = "ERROR"
-    return result.strip()
+    return result
 
 
 def replace_in_file(files, from_str, to_str):
@@ -11,7 +11,7 @@ from ._helpers import call_cmd
 def check_versions():
     try:
         git_ok = (
-            call_cmd("git version", exit_on_error=False, echo_cmd=False)
+            call_cmd(["git", "version"], exit_on_error=False, echo_cmd=False)
             >= "git version 2.22.0"
         )
     except Exception:
@@ -26,9 +26,9 @@ def check_versions():
         )
     try:
         docker_ok = (
-            call_cmd("docker --version", exit_on_error=False, echo_cmd=False).split(
-                ","
-            )[0]
+            call_cmd(
+                ["docker", "--version"], exit_on_error=False, echo_cmd=False
+            ).split(",")[0]
             >= "Docker version 18.09.6"
         )
     except Exception:
@@ -42,7 +42,7 @@ def check_versions():
     try:
         docker_compose_ok = (
             call_cmd(
-                "docker-compose --version", exit_on_error=False, echo_cmd=False
+                ["docker-compose", "--version"], exit_on_error=False, echo_cmd=False
             ).split(",")[0]
             >= "docker-compose version 1.21.0"
         )
@@ -63,7 +63,7 @@ def install_make():
             click.get_current_context().fail(
                 "Can't find apt package manager. Please install make manually."
             )
-        call_cmd("sudo -k -H apt install make")
+        call_cmd(["sudo", "-k", "-H", "apt", "install", "make"])
     else:
         click.get_current_context().fail(
             "As a windows user, you must install `make` manually. "
@@ -82,9 +82,9 @@ def install_precommit():
             click.get_current_context().fail(
                 "Can't find pip python package manager. Please install pip manually."
             )
-        call_cmd("sudo -k -H pip install pre-commit")
+        call_cmd(["sudo", "-k", "-H", "pip", "install", "pre-commit"])
     else:
-        call_cmd("pip install pre-commit")
+        call_cmd(["pip", "install", "pre-commit"])
 
 
 def install_compose_impersonation():
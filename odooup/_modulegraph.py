@@ -4,92 +4,617 @@
 
 import ast
 import os
+import subprocess
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import click
-import networkx as nx
 
-from ._helpers import call_cmd
+from . import _process
+from ._cache import JsonCache, get_cache_key
+from ._helpers import DEFAULT_JOBS, call_cmd
 
 MANIFEST_NAMES = ("__manifest__.py", "__openerp__.py", "__terp__.py")
 SKIP_PATHS = ["point_of_sale/tools"]
 
+GRAPH_BACKENDS = ("compact", "networkx")
 
-def _get_manifest_from_git(repo_path, manifest_object):
-    return call_cmd(
-        "git cat-file -p {manifest_object}".format(**locals()),
+Closure = namedtuple("Closure", "deps shortest longest")
+
+
+class DependencyCycle(Exception):
+    pass
+
+
+def _get_manifests_from_git(repo_path, manifest_objects):
+    """ Read many manifest blobs through one long-lived `git cat-file --batch`
+
+    Object ids are fed from a separate thread so that neither side of the pipe
+    can block on a full buffer while the size-prefixed responses are parsed
+    from the output stream.
+
+    :return: dict {manifest_object: manifest_str or None if not readable}
+    """
+    manifest_objects = list(manifest_objects)
+    argv = ["git", "cat-file", "--batch"]
+    started = time.time()
+    proc = subprocess.Popen(
+        argv,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        cwd=repo_path,
+    )
+
+    def _feed():
+        try:
+            for manifest_object in manifest_objects:
+                proc.stdin.write((manifest_object + "\n").encode("ascii"))
+            proc.stdin.close()
+        except (IOError, OSError):
+            # git went away, the reader side reports missing objects
+            pass
+
+    feeder = threading.Thread(target=_feed)
+    feeder.daemon = True
+    feeder.start()
+
+    manifests = {}
+    output_size = 0
+    try:
+        for manifest_object in manifest_objects:
+            # <sha> <type> <size>LF<contents>LF or <object> missingLF
+            header = proc.stdout.readline().split()
+            if len(header) != 3:
+                manifests[manifest_object] = None
+                continue
+            size = int(header[2])
+            contents = proc.stdout.read(size)
+            proc.stdout.read(1)
+            output_size += size
+            manifests[manifest_object] = contents.decode("utf-8", "replace")
+    finally:
+        if proc.poll() is None and feeder.is_alive():
+            proc.kill()
+        feeder.join()
+        proc.stdout.close()
+        _process.record(argv, repo_path, proc.wait(), output_size, started)
+    return manifests
+
+
+def _get_module_name(manifest_path):
+    return os.path.basename(os.path.dirname(manifest_path))
+
+
+def _get_tree_id(repo_path):
+    tree_id = call_cmd(
+        ["git", "rev-parse", "HEAD^{tree}"],
         echo_cmd=False,
         exit_on_error=False,
         cwd=repo_path,
     )
+    return tree_id if tree_id != "ERROR" else None
 
 
-def _find_addons(dir):
-    """ yield (addon_dir, addon_name, manifest) """
-    project = call_cmd(
-        "git ls-tree -r HEAD", echo_cmd=False, exit_on_error=False, cwd=dir
-    ).split("\n")
-    project = [i.split() for i in project]
-    project_submodule_paths = [i[3] for i in project if i[1] == "commit"]
-    manifests = {}
+def _scan_tree(repo_path):
+    """ ls-tree a repo's HEAD for its submodules and addon manifests """
+    tree = []
+    try:
+        for line in _process.stream(["git", "ls-tree", "-r", "HEAD"], cwd=repo_path):
+            # <mode> SP <type> SP <object> TAB <file>
+            info, _, path = line.partition("\t")
+            tree.append(info.split() + [path])
+    except subprocess.CalledProcessError:
+        pass
+    tree = [i for i in tree if len(i) == 4]
+    return {
+        "submodules": [i[3] for i in tree if i[1] == "commit"],
+        "manifests": [
+            (
+                _get_module_name(i[3]),  # module name
+                i[2],  # manifest object
+                i[3],  # manifest path relative to repo_path
+            )
+            for i in tree
+            if i[1] == "blob"
+            and any(M in i[3] for M in MANIFEST_NAMES)
+            and not any(S in i[3] for S in SKIP_PATHS)
+        ],
+    }
+
+
+def _get_scan(repo_path, tree_id, cache):
+    key = get_cache_key("tree", tree_id) if cache and tree_id else None
+    scan = cache.get(key) if key else None
+    if scan is None:
+        scan = _scan_tree(repo_path)
+        if key:
+            cache.set(key, scan)
+    return scan
+
+
+def _parse_manifests(manifests, cache):
+    """ literal_eval manifests, cat-file'ing only those not yet cached
+
+    :param manifests: iterable of (repo_path, manifest_object, manifest_path)
+    :return: dict {manifest_object: manifest} of the parsable manifests
+    """
+    parsed = {}
+    # One cat-file process per repository / submodule for uncached manifests
+    objects_per_repo = {}
+    for repo_path, manifest_object, _ in manifests:
+        manifest = None
+        if cache:
+            manifest = cache.get(get_cache_key("manifest", manifest_object))
+        if manifest is None:
+            objects_per_repo.setdefault(repo_path, []).append(manifest_object)
+        else:
+            parsed[manifest_object] = manifest
+    for repo_path, manifest_objects in objects_per_repo.items():
+        manifest_strs = _get_manifests_from_git(repo_path, manifest_objects)
+        for manifest_object, manifest_str in manifest_strs.items():
+            try:
+                manifest = ast.literal_eval(manifest_str or "")
+            except (SyntaxError, ValueError):
+                continue
+            parsed[manifest_object] = manifest
+            if cache:
+                cache.set(get_cache_key("manifest", manifest_object), manifest)
 
-    def _get_module_name(manifest_path):
-        return os.path.basename(os.path.dirname(manifest_path))
-
-    # First iterate on submodules in reversed alphabetical
-    # order (same as DockeryOdoo) -- for drop in module overrides
-    for submodule_path in reversed(sorted(project_submodule_paths)):
-        submodule = call_cmd(
-            "git ls-tree -r HEAD",
-            echo_cmd=False,
-            exit_on_error=False,
-            cwd=submodule_path,
-        ).split("\n")
-        submodule = [i.split() for i in submodule]
+    return parsed
+
+
+def _find_addons(dir, use_cache=True, jobs=DEFAULT_JOBS):
+    """ yield (addon_dir, addon_name, manifest_object, manifest)
+
+    With use_cache, ls-tree scans are cached by HEAD tree id, parsed manifests
+    by their blob id and the resulting addons by the combined tree ids of the
+    root repo and all of its submodules. Submodules are queried by up to `jobs`
+    concurrent git processes.
+    """
+    cache = JsonCache("modulegraph") if use_cache else None
+    root_tree_id = _get_tree_id(dir)
+    project = _get_scan(dir, root_tree_id, cache)
+    # Reversed alphabetical order (same as DockeryOdoo) -- for drop in module
+    # overrides: modules of alphabetically lower submodules take precedence
+    submodule_paths = list(reversed(sorted(project["submodules"])))
+    # Namespaces are relative to dir, git runs in the absolute repo paths
+    repo_paths = {path: os.path.join(dir, path) for path in submodule_paths}
+    pool = ThreadPoolExecutor(max_workers=max(jobs, 1))
+    tree_ids = dict(zip(submodule_paths, pool.map(_get_tree_id, repo_paths.values())))
+
+    graph_key = None
+    if cache and root_tree_id and all(tree_ids.values()):
+        graph_key = get_cache_key(
+            "graph",
+            root_tree_id,
+            *["{} {}".format(path, tree_ids[path]) for path in sorted(tree_ids)]
+        )
+        addons = cache.get(graph_key)
+        if addons is not None:
+            pool.shutdown()
+            for namespace, name, manifest_object, manifest in addons:
+                yield namespace, name, manifest_object, manifest
+            return
+
+    submodules = pool.map(
+        lambda path: _get_scan(repo_paths[path], tree_ids[path], cache),
+        submodule_paths,
+    )
+    pool.shutdown()
+    manifests = {}
+    # Merge in the submodule order, regardless of scan completion order
+    for submodule_path, submodule in zip(submodule_paths, submodules):
         manifests.update(
             {
-                _get_module_name(i[3]): (  # module name
-                    submodule_path,  # submodule base path
-                    i[2],  # manifest object
-                    os.path.join(submodule_path, i[3]),  # full manifest path
+                module: (
+                    repo_paths[submodule_path],
+                    manifest_object,
+                    os.path.join(submodule_path, manifest_path),  # full path
                 )
-                for i in submodule
-                if i[1] == "blob"
-                and any(M in i[3] for M in MANIFEST_NAMES)
-                and not any(S in i[3] for S in SKIP_PATHS)
+                for module, manifest_object, manifest_path in submodule["manifests"]
             }
         )
     # Always give src highest priority
     manifests.update(
         {
-            _get_module_name(i[3]): (  # module name
-                ".",  # relative to root repo path
-                i[2],  # manifest object
-                i[3],  # full manifest path
+            module: (
+                dir,
+                manifest_object,
+                manifest_path,
             )
-            for i in project
-            if i[1] == "blob"
-            and any(M in i[3] for M in MANIFEST_NAMES)
-            and not any(S in i[3] for S in SKIP_PATHS)
+            for module, manifest_object, manifest_path in project["manifests"]
         }
     )
-    for module, (repo_path, manifest_object, manifest_path) in manifests.items():
+
+    parsed = _parse_manifests(manifests.values(), cache)
+
+    addons = []
+    for module, (_, manifest_object, manifest_path) in manifests.items():
         module_path = os.path.dirname(manifest_path)
+        if manifest_object not in parsed:
+            click.secho("Error Parsing: {}".format(module_path), fg="yellow", err=True)
+            continue
+        addons.append(
+            (
+                os.path.dirname(module_path),
+                module,
+                manifest_object,
+                parsed[manifest_object],
+            )
+        )
+
+    if graph_key:
+        cache.set(graph_key, addons)
+        cache.evict()
+    for namespace, name, manifest_object, manifest in addons:
+        yield namespace, name, manifest_object, manifest
+
+
+class _Nodes(object):
+    """ Node attribute view of a ModuleGraph, like networkx' `g.nodes` """
+
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, module):
+        return self._graph._get_attrs(self._graph._ids[module])
+
+    def __contains__(self, module):
+        return module in self._graph._ids
+
+    def __iter__(self):
+        return iter(self._graph)
+
+    def __len__(self):
+        return len(self._graph)
+
+
+class ModuleGraph(object):
+    """ Compact module dependency graph
+
+    Modules are interned and indexed by integer ids, dependencies are kept as
+    adjacency lists of ids in both directions and of the manifest only the
+    fields odooup uses are retained. Supports the subset of the
+    `networkx.DiGraph` interface used by odooup: iteration, membership,
+    `nodes[module]`, `predecessors` (dependencies) and `successors`
+    (dependents). Modules only known as a dependency have empty attributes.
+    """
 
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+        self._namespaces = []
+        self._manifest_objects = []
+        self._auto_install = []
+        self._preds = []
+        self._succs = []
+        self.nodes = _Nodes(self)
+
+    def _get_id(self, module):
         try:
-            manifest_str = _get_manifest_from_git(repo_path, manifest_object)
-            manifest = ast.literal_eval(manifest_str)
-        except SyntaxError:
-            click.secho("Error Parsing: {}".format(module_path), fg="yellow")
-            continue
-        yield os.path.dirname(module_path), module, manifest
+            return self._ids[module]
+        except KeyError:
+            module_id = self._ids[sys.intern(module)] = len(self._names)
+            self._names.append(sys.intern(module))
+            self._namespaces.append(None)
+            self._manifest_objects.append(None)
+            self._auto_install.append(False)
+            self._preds.append([])
+            self._succs.append([])
+            return module_id
+
+    def _get_attrs(self, module_id):
+        if self._namespaces[module_id] is None:
+            return {}
+        return {
+            "namespace": self._namespaces[module_id],
+            "manifest_object": self._manifest_objects[module_id],
+            "manifest": {
+                "depends": [self._names[i] for i in self._preds[module_id]],
+                "auto_install": self._auto_install[module_id],
+            },
+        }
+
+    def add_module(self, module, namespace, manifest_object, manifest):
+        module_id = self._get_id(module)
+        self._namespaces[module_id] = sys.intern(namespace)
+        self._manifest_objects[module_id] = manifest_object
+        self._auto_install[module_id] = bool(manifest.get("auto_install"))
+        for dep in manifest.get("depends", []):
+            dep_id = self._get_id(dep)
+            if dep_id not in self._preds[module_id]:
+                self._preds[module_id].append(dep_id)
+                self._succs[dep_id].append(module_id)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __contains__(self, module):
+        return module in self._ids
+
+    def __len__(self):
+        return len(self._names)
+
+    def predecessors(self, module):
+        return iter([self._names[i] for i in self._preds[self._ids[module]]])
+
+    def successors(self, module):
+        return iter([self._names[i] for i in self._succs[self._ids[module]]])
+
+
+def _import_networkx():
+    try:
+        import networkx
+    except ImportError:
+        raise click.ClickException(
+            "The networkx graph backend requires networkx to be installed "
+            "(pip install odooup[networkx])."
+        )
+    return networkx
+
 
+def get_graph(dir, use_cache=True, jobs=DEFAULT_JOBS, backend="compact"):
+    """ The module dependency graph of the project in dir
 
-def get_graph(dir):
-    g = nx.DiGraph()
-    for namespace, name, manifest in _find_addons(dir):
-        g.add_node(name, manifest=manifest, namespace=namespace)
+    Edges point from a dependency to its dependent modules.
+
+    :param backend: "compact" for a ModuleGraph, "networkx" for a
+        networkx.DiGraph carrying the full manifests
+    """
+    if backend == "networkx":
+        g = _import_networkx().DiGraph()
+    else:
+        g = ModuleGraph()
+    for namespace, name, manifest_object, manifest in _find_addons(
+        dir, use_cache, jobs
+    ):
+        if backend != "networkx":
+            g.add_module(name, namespace, manifest_object, manifest)
+            continue
+        g.add_node(
+            name,
+            manifest=manifest,
+            namespace=namespace,
+            manifest_object=manifest_object,
+        )
         edges = zip(
             manifest.get("depends", []), [name] * len(manifest.get("depends", []))
         )
         g.add_edges_from(edges)
     return g
+
+
+def _walk(modules, get_next):
+    seen = set()
+    stack = list(modules)
+    while stack:
+        for module in get_next(stack.pop()):
+            if module not in seen:
+                seen.add(module)
+                stack.append(module)
+    return seen
+
+
+def get_ancestors(g, modules):
+    """ All modules any of modules depend on, directly or not """
+    return _walk(modules, g.predecessors)
+
+
+def get_descendants(g, modules):
+    """ All modules depending on any of modules, directly or not """
+    return _walk(modules, g.successors)
+
+
+def topological_sort(g, modules=None):
+    """ Sort modules (default all) dependencies first, ignoring other modules
+
+    Kahn's algorithm, visiting modules in a deterministic order.
+
+    :raise DependencyCycle: if the dependencies among modules are circular
+    """
+    modules = set(g) if modules is None else set(modules)
+    missing = {}
+    ready = []
+    for module in sorted(modules):
+        missing[module] = len([p for p in g.predecessors(module) if p in modules])
+        if not missing[module]:
+            ready.append(module)
+    order = []
+    ready.reverse()
+    while ready:
+        module = ready.pop()
+        order.append(module)
+        for succ in sorted(g.successors(module), reverse=True):
+            if succ in missing:
+                missing[succ] -= 1
+                if not missing[succ]:
+                    ready.append(succ)
+    if len(order) != len(modules):
+        raise DependencyCycle(sorted(modules - set(order)))
+    return order
+
+
+def _get_path(best, module):
+    """ Follow the predecessor links of best back from module """
+    path = []
+    while module is not None:
+        path.append(module)
+        module = best[module][1]
+    return path[::-1]
+
+
+def get_closures(g, modules, root="base"):
+    """ Dependency closures of many modules in one topological pass
+
+    Each node's ancestor set is built once from the (memoized) sets of its
+    predecessors, together with the shortest path from root and the longest
+    path leading to it. Only the part of the graph modules depend on is
+    visited.
+
+    :raise DependencyCycle: if the dependencies contain a cycle
+    :return: dict {module: Closure(deps, shortest or None, longest)}
+    """
+    needed = set(modules) | get_ancestors(g, modules)
+
+    deps = {}
+    # {node: (length, predecessor on the path)}
+    shortest = {}
+    longest = {}
+    for node in topological_sort(g, needed):
+        node_deps = set()
+        longest[node] = (0, None)
+        if node == root:
+            shortest[node] = (0, None)
+        for pred in g.predecessors(node):
+            node_deps |= deps[pred]
+            node_deps.add(pred)
+            if longest[pred][0] + 1 > longest[node][0]:
+                longest[node] = (longest[pred][0] + 1, pred)
+            if pred in shortest and (
+                node not in shortest or shortest[pred][0] + 1 < shortest[node][0]
+            ):
+                shortest[node] = (shortest[pred][0] + 1, pred)
+        deps[node] = node_deps
+
+    return {
+        module: Closure(
+            deps[module],
+            _get_path(shortest, module) if module in shortest else None,
+            _get_path(longest, module),
+        )
+        for module in modules
+    }
+
+
+def get_shortest_path(g, dependency, module):
+    """ The shortest dependency chain from dependency to module (BFS)
+
+    :return: list [dependency, ..., module] or None if module does not
+        depend on dependency
+    """
+    previous = {dependency: None}
+    queue = deque([dependency])
+    while queue:
+        node = queue.popleft()
+        if node == module:
+            path = [module]
+            while previous[path[-1]] is not None:
+                path.append(previous[path[-1]])
+            return path[::-1]
+        for succ in g.successors(node):
+            if succ not in previous:
+                previous[succ] = node
+                queue.append(succ)
+    return None
+
+
+def get_cycles(g):
+    """ Groups of modules depending on each other in a circle
+
+    The strongly connected components of more than one module, or of a
+    module depending on itself (iterative Tarjan).
+
+    :return: list of sorted lists of modules
+    """
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    cycles = []
+    for start in sorted(g):
+        if start in index:
+            continue
+        work = [(start, iter(sorted(g.successors(start))))]
+        index[start] = lowlink[start] = len(index)
+        stack.append(start)
+        on_stack.add(start)
+        while work:
+            node, succs = work[-1]
+            for succ in succs:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(sorted(g.successors(succ)))))
+                    break
+                if succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] != index[node]:
+                    continue
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                if len(component) > 1 or node in g.successors(node):
+                    cycles.append(sorted(component))
+    return sorted(cycles)
+
+
+def dump_graph(g):
+    """ A JSON serializable index of g
+
+    :return: dict {module: {"namespace", "manifest_object", "auto_install",
+        "depends", "rdepends"}}, namespace being None for modules only known
+        as a dependency
+    """
+    index = {}
+    for module in g:
+        node = g.nodes[module]
+        index[module] = {
+            "namespace": node.get("namespace"),
+            "manifest_object": node.get("manifest_object"),
+            "auto_install": bool(node and node["manifest"].get("auto_install")),
+            "depends": sorted(g.predecessors(module)),
+            "rdepends": sorted(g.successors(module)),
+        }
+    return index
+
+
+def load_graph(index):
+    """ A ModuleGraph from an index written by dump_graph """
+    g = ModuleGraph()
+    for module, entry in sorted(index.items()):
+        # Missing modules are added as the dependency of others
+        if entry["namespace"] is None:
+            continue
+        manifest = {"depends": entry["depends"], "auto_install": entry["auto_install"]}
+        g.add_module(module, entry["namespace"], entry["manifest_object"], manifest)
+    return g
+
+
+def get_waves(g, modules=None):
+    """ Group modules (default all) in waves installable one after another
+
+    A module is part of the wave right after the latest of its dependencies
+    (Kahn levels), so all modules of a wave can be installed in parallel.
+    The critical path is a longest dependency chain, one module per wave.
+
+    :raise DependencyCycle: if the dependencies among modules are circular
+    :return: tuple (list of sorted lists of modules, critical path)
+    """
+    order = topological_sort(g, modules)
+    members = set(order)
+    # {module: (wave, dependency in the previous wave)}
+    best = {}
+    for module in order:
+        best[module] = (0, None)
+        for pred in sorted(g.predecessors(module)):
+            if pred in members and best[pred][0] + 1 > best[module][0]:
+                best[module] = (best[pred][0] + 1, pred)
+    if not order:
+        return [], []
+    waves = [[] for _ in range(max(wave for wave, _ in best.values()) + 1)]
+    for module in sorted(order):
+        waves[best[module][0]].append(module)
+    return waves, _get_path(best, waves[-1][0])
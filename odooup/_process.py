@@ -0,0 +1,125 @@
+# Copyright 2019 XOE Labs (<https://xoe.solutions>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+"""Run external commands from argv lists, without a shell in between.
+
+Every finished command is timed and handed to the registered listeners as a
+`Record`, whatever the way it was run.
+"""
+
+import subprocess
+import threading
+import time
+from collections import namedtuple
+
+Result = namedtuple("Result", "argv cwd returncode output duration")
+Record = namedtuple("Record", "argv cwd returncode output_size started duration thread")
+
+_listeners = []
+
+
+def add_listener(listener):
+    """Call listener(record) for every command finished from now on"""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+def record(argv, cwd, returncode, output_size, started):
+    """Notify listeners of a finished command started at `started`"""
+    if not _listeners:
+        return
+    rec = Record(
+        list(argv),
+        cwd,
+        returncode,
+        output_size,
+        started,
+        time.time() - started,
+        threading.current_thread().name,
+    )
+    for listener in list(_listeners):
+        listener(rec)
+
+
+def _not_found(argv, exc):
+    # Same as a shell would report an unknown command
+    return subprocess.CalledProcessError(127, argv, output=str(exc))
+
+
+def run(argv, cwd=None, check=True, timeout=None, capture_stderr=True):
+    """Run argv and capture its output (stdout and, by default, stderr)
+
+    :raise subprocess.CalledProcessError: if check and argv fails
+    :raise subprocess.TimeoutExpired: if argv ran longer than timeout seconds
+    :return: Result
+    """
+    started = time.time()
+    try:
+        proc = subprocess.run(
+            argv,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if capture_stderr else None,
+            cwd=cwd,
+            timeout=timeout,
+            universal_newlines=True,
+        )
+    except subprocess.TimeoutExpired as exc:
+        record(argv, cwd, None, len(exc.output or ""), started)
+        raise
+    except OSError as exc:
+        record(argv, cwd, 127, 0, started)
+        raise _not_found(argv, exc)
+    record(argv, cwd, proc.returncode, len(proc.stdout), started)
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, argv, output=proc.stdout)
+    return Result(argv, cwd, proc.returncode, proc.stdout, time.time() - started)
+
+
+def stream(argv, cwd=None, timeout=None):
+    """Run argv, yielding its stdout line by line (without line endings)
+
+    stderr passes through. The command is killed if it is still running
+    after timeout seconds, or if the caller stops consuming early.
+
+    :raise subprocess.CalledProcessError: once exhausted, if argv failed
+    :raise subprocess.TimeoutExpired: if argv ran longer than timeout seconds
+    """
+    started = time.time()
+    try:
+        proc = subprocess.Popen(
+            argv, stdout=subprocess.PIPE, cwd=cwd, universal_newlines=True
+        )
+    except OSError as exc:
+        record(argv, cwd, 127, 0, started)
+        raise _not_found(argv, exc)
+    timed_out = []
+    timer = None
+    if timeout:
+
+        def _kill():
+            timed_out.append(True)
+            proc.kill()
+
+        timer = threading.Timer(timeout, _kill)
+        timer.start()
+    output_size = 0
+    exhausted = False
+    try:
+        for line in proc.stdout:
+            output_size += len(line)
+            yield line.rstrip("\n")
+        exhausted = True
+    finally:
+        if timer:
+            timer.cancel()
+        if not exhausted and proc.poll() is None:
+            proc.kill()
+        proc.stdout.close()
+        returncode = proc.wait()
+        record(argv, cwd, returncode, output_size, started)
+    if timed_out:
+        raise subprocess.TimeoutExpired(argv, timeout)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, argv)
@@ -0,0 +1,96 @@
+# Copyright 2019 XOE Labs (<https://xoe.solutions>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+"""Collect the external commands run by odooup into a timeline.
+
+The timeline is written in the Chrome trace event format, it can be loaded
+into chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import json
+import os
+import threading
+
+import click
+
+
+def _get_name(argv):
+    # git --git-dir=... checkout -b x -> git checkout
+    words = [os.path.basename(argv[0])] + [a for a in argv[1:] if a[:1] != "-"]
+    return " ".join(words[:2])
+
+
+class Tracer(object):
+    """A _process listener keeping all records of a run"""
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def write(self, path):
+        """Write the records as Chrome trace events to path"""
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for record in sorted(self.records, key=lambda r: r.started):
+            tid = threads.setdefault(record.thread, len(threads) + 1)
+            events.append(
+                {
+                    "name": _get_name(record.argv),
+                    "cat": "cmd",
+                    "ph": "X",
+                    "ts": int(record.started * 1e6),
+                    "dur": int(record.duration * 1e6),
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {
+                        "argv": record.argv,
+                        "cwd": record.cwd or os.getcwd(),
+                        "exit_code": record.returncode,
+                        "output_bytes": record.output_size,
+                    },
+                }
+            )
+        for thread, tid in threads.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": thread},
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def echo_summary(self, limit=10):
+        """Echo totals per command and the slowest calls to stderr"""
+        totals = {}
+        for record in self.records:
+            name = _get_name(record.argv)
+            count, duration = totals.get(name, (0, 0.0))
+            totals[name] = (count + 1, duration + record.duration)
+        click.secho(
+            "Trace: {} commands, {:.3f}s total".format(
+                len(self.records), sum(r.duration for r in self.records)
+            ),
+            fg="blue",
+            bold=True,
+            err=True,
+        )
+        by_duration = sorted(totals.items(), key=lambda i: i[1][1], reverse=True)
+        for name, (count, duration) in by_duration[:limit]:
+            click.echo("\t{:8.3f}s {:5}x {}".format(duration, count, name), err=True)
+        click.secho("Slowest:", fg="blue", bold=True, err=True)
+        slowest = sorted(self.records, key=lambda r: r.duration, reverse=True)
+        for record in slowest[:limit]:
+            click.echo(
+                "\t{:8.3f}s [{}] {}".format(
+                    record.duration, record.returncode, " ".join(record.argv)
+                ),
+                err=True,
+            )
@@ -0,0 +1,201 @@
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+
+from ._cache import (
+    cache_repos,
+    get_cache_dir,
+    get_cached_repos,
+    get_repo_status,
+    optimize_repo,
+    remove_repo,
+)
+from ._helpers import DEFAULT_JOBS
+
+
+def _format_size(size):
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = "T"
+    return "{:.1f}{}".format(size, unit)
+
+
+def _format_age(timestamp):
+    if not timestamp:
+        return "never"
+    age = time.time() - timestamp
+    for unit, seconds in (("d", 86400), ("h", 3600), ("m", 60)):
+        if age >= seconds:
+            return "{}{} ago".format(int(age // seconds), unit)
+    return "{}s ago".format(int(age))
+
+
+def _get_name(repo_cache_dir):
+    return os.path.relpath(repo_cache_dir, get_cache_dir())
+
+
+@click.group()
+def cache():
+    """Maintain the repo cache used for cloning."""
+    pass
+
+
+@cache.command()
+def status():
+    """Show size, last fetch and last use per cached repo."""
+    total = 0
+    for repo_cache_dir in get_cached_repos():
+        repo = get_repo_status(repo_cache_dir)
+        total += repo["size"]
+        branches = ", ".join(repo["branches"]) if repo["branches"] is not None else "*"
+        click.secho(_get_name(repo_cache_dir), fg="green", bold=True, nl=False)
+        click.secho(" [{}]".format(branches), fg="yellow")
+        click.echo(
+            "\tSize: {}, Fetched: {}, Used: {}".format(
+                _format_size(repo["size"]),
+                _format_age(repo["fetched"]),
+                _format_age(repo["used"]),
+            )
+        )
+    click.secho("Total: {} in {}".format(_format_size(total), get_cache_dir()))
+
+
+@cache.command()
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=DEFAULT_JOBS,
+    show_default=True,
+    help="Number of repos to optimize concurrently.",
+)
+def gc(jobs):
+    """Repack cached repos with bitmaps and write their commit-graphs."""
+    repos = get_cached_repos()
+    failed = False
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for repo_cache_dir in repos:
+            future = pool.submit(optimize_repo, repo_cache_dir, raise_on_error=True)
+            futures[future] = repo_cache_dir
+        for done, future in enumerate(as_completed(futures), 1):
+            progress = "[{}/{}] {}".format(
+                done, len(futures), _get_name(futures[future])
+            )
+            try:
+                future.result()
+            except subprocess.CalledProcessError as exc:
+                failed = True
+                click.secho(progress + " ... failed", fg="red")
+                click.secho("\t" + str(exc.output).strip(), fg="red")
+                continue
+            click.secho(progress + " ... done", fg="yellow")
+    if failed:
+        click.get_current_context().exit(code=1)
+
+
+@cache.command()
+@click.option(
+    "--days",
+    type=click.IntRange(min=0),
+    default=90,
+    show_default=True,
+    help="Evict repos not used for cloning within this many days.",
+)
+@click.option(
+    "--dry-run", is_flag=True, default=False, help="Only list repos to evict."
+)
+@click.option(
+    "--force", is_flag=True, default=False, help="Evict without confirmation."
+)
+def prune(days, dry_run, force):
+    """Evict cached repos not used within a number of days.
+
+    Repos without a recorded use (eg. only warmed) age from their last fetch.
+    Repos still borrowed from by projects cloned without --dissociate are kept,
+    evicting them would corrupt these projects.
+    """
+    threshold = time.time() - days * 86400
+    to_evict = []
+    for repo_cache_dir in get_cached_repos():
+        repo = get_repo_status(repo_cache_dir)
+        if (repo["used"] or repo["fetched"] or 0) >= threshold:
+            continue
+        if repo["borrowers"]:
+            click.secho(
+                "Keeping {}, still borrowed from by {}".format(
+                    _get_name(repo_cache_dir), ", ".join(repo["borrowers"])
+                ),
+                fg="green",
+            )
+            continue
+        click.secho(
+            "Evicting {} ({}, used {})".format(
+                _get_name(repo_cache_dir),
+                _format_size(repo["size"]),
+                _format_age(repo["used"]),
+            ),
+            fg="yellow",
+        )
+        to_evict.append(repo_cache_dir)
+    if not to_evict or dry_run:
+        return
+    if not force and not click.confirm("Evict {} repos?".format(len(to_evict))):
+        return
+    for repo_cache_dir in to_evict:
+        remove_repo(repo_cache_dir)
+
+
+@cache.command()
+@click.option(
+    "--branch",
+    "-b",
+    "branches",
+    multiple=True,
+    help="Only fetch this branch (repeatable), instead of what is cached.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=DEFAULT_JOBS,
+    show_default=True,
+    help="Number of repos to fetch concurrently.",
+)
+@click.argument("urls", nargs=-1)
+def warm(urls, branches, jobs):
+    """Fetch repos into the cache ahead of cloning.
+
+    URLS default to all cached repos, refreshing the branches they hold.
+    """
+    repo_branches = {}
+    if not urls:
+        for repo_cache_dir in get_cached_repos():
+            repo = get_repo_status(repo_cache_dir)
+            if not repo["url"]:
+                click.secho(
+                    "Skipping {}: origin unknown".format(_get_name(repo_cache_dir)),
+                    fg="yellow",
+                )
+                continue
+            repo_branches[repo["url"]] = repo["branches"]
+    else:
+        repo_branches = {url: None for url in urls}
+    if branches:
+        repo_branches = {url: list(branches) for url in repo_branches}
+    _, failures = cache_repos(list(repo_branches), jobs=jobs, branches=repo_branches)
+    for url, error in sorted(failures.items()):
+        click.secho(url + ":", fg="red", bold=True)
+        click.secho("\t" + error, fg="red")
+    if failures:
+        click.get_current_context().exit(code=1)
+
+
+if __name__ == "__main__":
+    cache()
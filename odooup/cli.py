@@ -4,20 +4,108 @@
 
 __version__ = "0.1.2"
 
+import importlib
 import sys
 
 import click
-from click_plugins import with_plugins
-from pkg_resources import iter_entry_points
+
+from . import _process
+from ._trace import Tracer
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:  # Python < 3.8
+    from importlib_metadata import entry_points
 
 CONTEXT_SETTINGS = dict(auto_envvar_prefix="ODOOUP")
+PLUGINS_GROUP = "core_package.cli_plugins"
+
+# Built-in subcommands, their modules are only imported when invoked
+COMMANDS = {
+    "cache": "odooup.cache:cache",
+    "clone": "odooup.clone:clone",
+    "graph": "odooup.graph:graph",
+    "init": "odooup.init:init",
+    "patches": "odooup.patches:patches",
+    "whitelist": "odooup.whitelist:whitelist",
+}
+
+
+def _load(path):
+    module, _, attr = path.partition(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+def _get_plugin_entry_points():
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        return eps.select(group=PLUGINS_GROUP)
+    return eps.get(PLUGINS_GROUP, [])
+
+
+class LazyGroup(click.Group):
+    """ A group resolving built-in and plugin subcommands by name only once
+    they are needed, instead of importing all of them upfront. """
 
+    _plugins = None
 
-@with_plugins(iter_entry_points("core_package.cli_plugins"))
-@click.group(context_settings=CONTEXT_SETTINGS)
-def main():
+    def _get_plugins(self):
+        if self._plugins is None:
+            self._plugins = {
+                ep.name: ep
+                for ep in _get_plugin_entry_points()
+                if ep.name not in COMMANDS and ep.name not in self.commands
+            }
+        return self._plugins
+
+    def list_commands(self, ctx):
+        commands = set(super(LazyGroup, self).list_commands(ctx))
+        return sorted(commands | set(COMMANDS) | set(self._get_plugins()))
+
+    def get_command(self, ctx, name):
+        cmd = super(LazyGroup, self).get_command(ctx, name)
+        if cmd is not None:
+            return cmd
+        if name in COMMANDS:
+            return _load(COMMANDS[name])
+        ep = self._get_plugins().get(name)
+        if ep is None:
+            return None
+        try:
+            return ep.load()
+        except Exception as exc:
+            return _broken_plugin(name, exc)
+
+
+def _broken_plugin(name, exc):
+    @click.command(name, help="Warning: plugin could not be loaded.")
+    def broken():
+        click.secho("Plugin '{}' could not be loaded: {!r}".format(name, exc), fg="red")
+        click.get_current_context().exit(code=1)
+
+    return broken
+
+
+@click.group(cls=LazyGroup, context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "--trace",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Record all external commands into a Chrome trace (JSON) file "
+    "and summarize the slowest ones.",
+)
+@click.pass_context
+def main(ctx, trace):
     """Commandline interface for OdooUp commands."""
-    pass
+    if trace:
+        tracer = Tracer()
+        _process.add_listener(tracer)
+
+        def _finish():
+            _process.remove_listener(tracer)
+            tracer.write(trace)
+            tracer.echo_summary()
+
+        ctx.call_on_close(_finish)
 
 
 @main.command()
@@ -1,86 +1,158 @@
 import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import click
 
-from ._cache import cache_repo
-from ._helpers import call_cmd, get_fs_target, mkdir_p, parse_git_url
+from ._cache import CACHE_MAX_AGE, CACHE_MODES, add_borrower, cache_repo, cache_repos
+from ._helpers import DEFAULT_JOBS, call_cmd, get_fs_target, mkdir_p, parse_git_url
 from ._installers import install_tools
 from .whitelist import ensure_sparse_checkouts
 
 
-def _clone(branch, url):
-    repo_cache_dir = cache_repo(*parse_git_url(url))
-    reference = "--reference {}".format(repo_cache_dir)
+def _clone(branch, url, max_age, cache_mode):
+    branches = [branch] if cache_mode == "branch" else None
+    repo_cache_dir = cache_repo(
+        *parse_git_url(url), max_age=max_age, branches=branches, mark_used=True
+    )
     target = get_fs_target(url)
     call_cmd(
-        "git clone -b {branch} {reference} --dissociate "
-        "{url} {target}".format(**locals()),
+        ["git", "clone", "-b", branch, "--reference", repo_cache_dir]
+        + ["--dissociate", url, target],
         echo_cmd=True,
         exit_on_error=True,
     )
     return target
 
 
-def _clone_submodules(branch, target, dissociate):
-    submodules = [
-        s.split(" ")[1]
-        for s in call_cmd(
-            "git submodule", echo_cmd=False, exit_on_error=True, cwd=target
-        ).split("\n")
-        if s
-    ]
-    for submodule in submodules:
-        click.secho("Getting Submodule: {}".format(submodule), fg="yellow")
-        name = call_cmd(
-            "git submodule--helper name {}".format(submodule),
-            echo_cmd=False,
-            exit_on_error=True,
-            cwd=target,
-        )
-        url = call_cmd(
-            "git submodule--helper config submodule.{}.url".format(name),
-            echo_cmd=False,
-            exit_on_error=True,
-            cwd=target,
-        )
+def _get_submodules(target):
+    """ [(path, url, branch)] of the submodules registered in .gitmodules """
+    config = call_cmd(
+        ["git", "config", "-f", ".gitmodules", "--get-regexp"]
+        + [r"^submodule\..*\.(path|url|branch)$"],
+        echo_cmd=False,
+        exit_on_error=False,
+        cwd=target,
+    )
+    if config == "ERROR":  # No submodules at all
+        return []
+    submodules = {}
+    for line in config.split("\n"):
+        key, _, value = line.partition(" ")
+        name, _, attr = key[len("submodule.") :].rpartition(".")
+        submodules.setdefault(name, {})[attr] = value
+    result = []
+    for name, submodule in sorted(submodules.items()):
+        url = submodule["url"]
         if url.startswith(".") or url.startswith(".."):
             url = call_cmd(
-                "git submodule--helper resolve-relative-url {}".format(url),
+                ["git", "submodule--helper", "resolve-relative-url", url],
                 echo_cmd=False,
                 exit_on_error=True,
                 cwd=target,
             )
-        repo_cache_dir = cache_repo(*parse_git_url(url))
-        reference = "--reference {}".format(repo_cache_dir)
-        dissociate = "--dissociate" if dissociate else ""
-        call_cmd(
-            "git submodule update {reference} --init {dissociate} "
-            "-- {submodule}".format(**locals()),
-            echo_cmd=True,
-            exit_on_error=False,
-            cwd=target,
-        )
+        result.append((submodule["path"], url, submodule.get("branch")))
+    return result
+
+
+def _clone_submodule(branch, target, dissociate, path, repo_cache_dir):
+    """ Get a single submodule referencing the cache, raise on any failure """
+    cmd = ["git", "submodule", "update", "--reference", repo_cache_dir]
+    if dissociate:
+        cmd.append("--dissociate")
     call_cmd(
-        "git submodule foreach git config remote.origin.fetch "
-        "+refs/heads/{branch}:refs/remotes/origin/{branch}".format(**locals()),
+        cmd + ["--", path],
         echo_cmd=False,
-        exit_on_error=True,
         cwd=target,
+        raise_on_error=True,
     )
+    submodule_dir = os.path.join(target, path)
+    if not dissociate:
+        git_dir = call_cmd(
+            ["git", "rev-parse", "--absolute-git-dir"],
+            echo_cmd=False,
+            cwd=submodule_dir,
+            raise_on_error=True,
+        )
+        add_borrower(repo_cache_dir, git_dir)
     call_cmd(
-        "git submodule foreach git fetch --all --prune",
+        ["git", "config", "remote.origin.fetch"]
+        + ["+refs/heads/{branch}:refs/remotes/origin/{branch}".format(**locals())],
         echo_cmd=False,
-        exit_on_error=True,
-        cwd=target,
+        cwd=submodule_dir,
+        raise_on_error=True,
+    )
+    call_cmd(
+        ["git", "fetch", "--all", "--prune"],
+        echo_cmd=False,
+        cwd=submodule_dir,
+        raise_on_error=True,
+    )
+
+
+def _clone_submodules(
+    branch, target, dissociate, jobs=DEFAULT_JOBS, max_age=0, cache_mode="all"
+):
+    """ Get all submodules with up to `jobs` concurrent workers
+
+    :return: dict {submodule path: error message} of failed submodules
+    """
+    submodules = _get_submodules(target)
+    # Register all submodule urls at once, workers then only clone
+    call_cmd(
+        ["git", "submodule", "init"], echo_cmd=False, exit_on_error=True, cwd=target
+    )
+    branches = None
+    if cache_mode == "branch":
+        # Submodules track the project branch unless configured otherwise
+        branches = {}
+        for _, url, submodule_branch in submodules:
+            branches.setdefault(url, []).append(submodule_branch or branch)
+    cached, cache_failures = cache_repos(
+        [url for _, url, _ in submodules], max_age, jobs, branches, mark_used=True
+    )
+    failures = {
+        path: cache_failures[url]
+        for path, url, _ in submodules
+        if url in cache_failures
+    }
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(
+                _clone_submodule, branch, target, dissociate, path, cached[url]
+            ): path
+            for path, url, _ in submodules
+            if url in cached
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            progress = "[{}/{}] {}".format(done, len(futures), path)
+            try:
+                future.result()
+            except subprocess.CalledProcessError as exc:
+                failures[path] = "{}\n{}".format(exc.cmd, str(exc.output).strip())
+            if path in failures:
+                click.secho(progress + " ... failed", fg="red")
+            else:
+                click.secho(progress + " ... done", fg="yellow")
+    return failures
+
+
+def _report_failures(failures):
+    click.secho(
+        "Failed getting {} submodule(s):".format(len(failures)), fg="red", bold=True
     )
+    for path, error in sorted(failures.items()):
+        click.secho(path + ":", fg="red", bold=True)
+        for line in error.split("\n"):
+            click.secho("\t" + line, fg="red")
 
 
 def clone_submodule_to_target(branch, url, target):
-    repo_cache_dir = cache_repo(*parse_git_url(url))
-    reference = "--reference {}".format(repo_cache_dir)
+    repo_cache_dir = cache_repo(*parse_git_url(url), branches=[branch], mark_used=True)
     call_cmd(
-        "git submodule add -b {branch} {reference} --dissociate "
-        "{url} {target}".format(**locals()),
+        ["git", "submodule", "add", "-b", branch, "--reference", repo_cache_dir]
+        + ["--dissociate", url, target],
         echo_cmd=True,
         exit_on_error=False,
     )
@@ -105,22 +177,50 @@ def get_vendor_target(repo_url):
     default=False,
     help="Dissociate cloned submodules from cache.",
 )
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=DEFAULT_JOBS,
+    show_default=True,
+    help="Number of submodules to clone concurrently.",
+)
+@click.option(
+    "--cache-max-age",
+    type=click.IntRange(min=0),
+    default=CACHE_MAX_AGE,
+    show_default=True,
+    help="Seconds within which a refreshed repo cache is not fetched again.",
+)
+@click.option(
+    "--cache-mode",
+    type=click.Choice(CACHE_MODES),
+    default="branch",
+    show_default=True,
+    help="Fetch only the needed branches or all branches into repo caches.",
+)
 @click.argument("branch", required=True)
 @click.argument("url", required=True)
-def clone(branch, url, whitelist, dissociate):
+def clone(branch, url, whitelist, dissociate, jobs, cache_max_age, cache_mode):
     """Clone an OdooUp project."""
     install_tools()
-    target = _clone(branch, url)
-    _clone_submodules(branch, target, dissociate)
+    target = _clone(branch, url, cache_max_age, cache_mode)
+    failures = _clone_submodules(
+        branch, target, dissociate, jobs, cache_max_age, cache_mode
+    )
     if whitelist:
         ensure_sparse_checkouts(target)
     call_cmd(
-        "git config commit.template " "{}/.git-commit-template".format(target),
+        ["git", "config", "commit.template"]
+        + ["{}/.git-commit-template".format(target)],
         cwd=target,
     )
-    call_cmd("pre-commit install --hook-type pre-commit", cwd=target)
-    call_cmd("pre-commit install --hook-type commit-msg", cwd=target)
-    call_cmd("pre-commit install --install-hooks", cwd=target)
+    call_cmd(["pre-commit", "install", "--hook-type", "pre-commit"], cwd=target)
+    call_cmd(["pre-commit", "install", "--hook-type", "commit-msg"], cwd=target)
+    call_cmd(["pre-commit", "install", "--install-hooks"], cwd=target)
+    if failures:
+        _report_failures(failures)
+        click.get_current_context().exit(code=1)
 
 
 if __name__ == "__main__":
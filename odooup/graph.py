@@ -0,0 +1,357 @@
+import json
+import os
+import subprocess
+import tempfile
+
+import click
+
+from . import _process
+from ._helpers import DEFAULT_JOBS, call_cmd
+from ._modulegraph import (
+    DependencyCycle,
+    dump_graph,
+    get_ancestors,
+    get_cycles,
+    get_descendants,
+    get_graph,
+    get_shortest_path,
+    get_waves,
+    load_graph,
+    topological_sort,
+)
+
+SNAPSHOT_FILE = "odooup-graph.json"
+SNAPSHOT_VERSION = 1
+
+
+def _get_top_level():
+    top_level = call_cmd(
+        ["git", "rev-parse", "--show-toplevel"], echo_cmd=False, exit_on_error=False
+    )
+    if top_level == "ERROR":
+        click.get_current_context().fail("You are not inside a work tree.")
+    return top_level
+
+
+def _get_snapshot_path(top_level):
+    git_dir = call_cmd(["git", "rev-parse", "--git-dir"], echo_cmd=False, cwd=top_level)
+    return os.path.join(top_level, git_dir, SNAPSHOT_FILE)
+
+
+def _get_head_tree(top_level):
+    tree_id = call_cmd(
+        ["git", "rev-parse", "HEAD^{tree}"],
+        echo_cmd=False,
+        exit_on_error=False,
+        cwd=top_level,
+    )
+    return tree_id if tree_id != "ERROR" else None
+
+
+def _build_snapshot(top_level, use_cache=True, jobs=DEFAULT_JOBS):
+    """ Build the module graph and persist it as snapshot in the git dir """
+    g = get_graph(top_level, use_cache=use_cache, jobs=jobs)
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "tree": _get_head_tree(top_level),
+        "modules": dump_graph(g),
+    }
+    snapshot_path = _get_snapshot_path(top_level)
+    # Write atomically, concurrent CI jobs might query the same snapshot
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(snapshot_path))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(snapshot, f, sort_keys=True)
+        os.rename(tmp_path, snapshot_path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return g
+
+
+def _load_snapshot(top_level):
+    """ The module graph snapshot, None if missing or not of HEAD's tree """
+    try:
+        with open(_get_snapshot_path(top_level), "r") as f:
+            snapshot = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    if snapshot.get("tree") != _get_head_tree(top_level):
+        return None
+    return load_graph(snapshot["modules"])
+
+
+def _get_graph():
+    """ The module graph from the snapshot, (re)built first if outdated """
+    top_level = _get_top_level()
+    g = _load_snapshot(top_level)
+    if g is None:
+        click.secho("Building module graph snapshot ...", fg="green", err=True)
+        g = _build_snapshot(top_level)
+    return g
+
+
+def _get_rev_range(rev_range):
+    """ Diff endpoints of `A..B`, `A...B` (from their merge base) or `A`
+    (up to HEAD) """
+    if "..." in rev_range:
+        old, _, new = rev_range.partition("...")
+        old = call_cmd(
+            ["git", "merge-base", old or "HEAD", new or "HEAD"], echo_cmd=False
+        )
+        return old, new or "HEAD"
+    old, _, new = rev_range.partition("..")
+    return old or "HEAD", new or "HEAD"
+
+
+def _diff_raw(old, new, cwd):
+    """ yield (old_mode, new_mode, old_object, new_object, path) of the paths
+    changed from old to new
+
+    :raise subprocess.CalledProcessError: if old or new are unknown
+    """
+    output = _process.run(
+        ["git", "diff", "--raw", "--no-abbrev", "--no-renames", "-z", old, new],
+        cwd=cwd,
+        capture_stderr=False,
+    ).output
+    fields = output.split("\0")
+    # :<old mode> <new mode> <old object> <new object> <status> NUL <path> NUL
+    for info, path in zip(fields[0::2], fields[1::2]):
+        old_mode, new_mode, old_object, new_object, _ = info[1:].split(" ")
+        yield old_mode, new_mode, old_object, new_object, path
+
+
+def _get_changed_paths(top_level, old, new):
+    """ Paths changed from old to new, including those within submodules
+    (changed gitlinks are diffed in the submodule's checkout) """
+    paths = set()
+    for old_mode, new_mode, old_object, new_object, path in _diff_raw(
+        old, new, top_level
+    ):
+        if new_mode != "160000" or old_mode != "160000":
+            paths.add(path)
+            continue
+        try:
+            for entry in _diff_raw(
+                old_object, new_object, os.path.join(top_level, path)
+            ):
+                paths.add(path + "/" + entry[-1])
+        except (OSError, subprocess.CalledProcessError):
+            paths.add(path)
+            click.secho(
+                "Commits of {} not available, considering all of its modules "
+                "changed.".format(path),
+                fg="yellow",
+                err=True,
+            )
+    return paths
+
+
+def _get_changed_modules(g, paths):
+    """ The modules containing any of paths, a path of a (changed)
+    submodule standing for all modules within """
+    module_dirs = {g.nodes[m]["namespace"] + "/" + m: m for m in g if g.nodes[m]}
+    changed = set()
+    for path in paths:
+        parts = path.split("/")
+        for i in range(1, len(parts) + 1):
+            module = module_dirs.get("/".join(parts[:i]))
+            if module:
+                changed.add(module)
+                break
+        else:
+            prefix = path + "/"
+            changed |= {m for d, m in module_dirs.items() if d.startswith(prefix)}
+    return changed
+
+
+def _check_module(g, module):
+    if module not in g:
+        click.secho(
+            "UNKNOWN MODULE: '{}' is not in the module graph.".format(module),
+            fg="red",
+            bold=True,
+            err=True,
+        )
+        click.get_current_context().exit(code=1)
+
+
+def _echo_modules(modules):
+    for module in modules:
+        click.echo(module)
+
+
+def _exit_on_cycle(cycle):
+    click.secho(
+        "DEPENDENCY CYCLE: Among " + ", ".join(cycle.args[0]), fg="red", err=True
+    )
+    click.get_current_context().exit(code=1)
+
+
+def _echo_sorted(g, modules):
+    """ Echo modules in topological order, exit with 1 on cycles """
+    try:
+        ordered = topological_sort(g, modules)
+    except DependencyCycle as e:
+        _exit_on_cycle(e)
+    _echo_modules(ordered)
+
+
+@click.group()
+def graph():
+    """Query the module graph of a project.
+
+    Queries are answered from a snapshot in the git dir, which is (re)built
+    whenever the project's HEAD changed. Run `build` to refresh it after
+    checking out other submodule commits."""
+    pass
+
+
+@graph.command()
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help="Reuse module graph data cached for unchanged commits.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=DEFAULT_JOBS,
+    show_default=True,
+    help="Number of submodules to scan concurrently.",
+)
+def build(cache, jobs):
+    """(Re)build the module graph snapshot."""
+    top_level = _get_top_level()
+    g = _build_snapshot(top_level, use_cache=cache, jobs=jobs)
+    click.secho(
+        "{} modules in {}".format(len(g), _get_snapshot_path(top_level)), fg="green"
+    )
+
+
+@graph.command()
+@click.option("--direct", is_flag=True, help="Only list direct dependencies.")
+@click.argument("module", required=True)
+def deps(module, direct):
+    """List the dependencies of MODULE, dependencies first."""
+    g = _get_graph()
+    _check_module(g, module)
+    modules = set(g.predecessors(module)) if direct else get_ancestors(g, [module])
+    _echo_sorted(g, modules)
+
+
+@graph.command()
+@click.option("--direct", is_flag=True, help="Only list direct dependents.")
+@click.argument("module", required=True)
+def rdeps(module, direct):
+    """List the modules depending on MODULE, dependencies first."""
+    g = _get_graph()
+    _check_module(g, module)
+    modules = set(g.successors(module)) if direct else get_descendants(g, [module])
+    _echo_sorted(g, modules)
+
+
+@graph.command()
+@click.argument("module", required=True)
+@click.argument("dependency", required=True)
+def path(module, dependency):
+    """Show the shortest dependency chain from DEPENDENCY to MODULE."""
+    g = _get_graph()
+    _check_module(g, module)
+    _check_module(g, dependency)
+    shortest = get_shortest_path(g, dependency, module)
+    if not shortest:
+        click.secho(
+            "'{}' does not depend on '{}'.".format(module, dependency),
+            fg="yellow",
+            err=True,
+        )
+        click.get_current_context().exit(code=1)
+    click.echo(" > ".join(shortest))
+
+
+@graph.command()
+def cycles():
+    """List circular dependencies, exit with 1 if there are any."""
+    found = get_cycles(_get_graph())
+    for cycle in found:
+        click.echo(", ".join(cycle))
+    if found:
+        click.get_current_context().exit(code=1)
+
+
+@graph.command()
+def orphans():
+    """List the vendored modules no module in ./src depends on."""
+    g = _get_graph()
+    src_modules = [m for m in g if g.nodes[m] and "src" in g.nodes[m]["namespace"]]
+    needed = get_ancestors(g, src_modules)
+    _echo_modules(
+        sorted(
+            m
+            for m in g
+            if g.nodes[m] and m not in needed and "src" not in g.nodes[m]["namespace"]
+        )
+    )
+
+
+@graph.command()
+@click.option(
+    "--changed-only", is_flag=True, help="Omit modules only depending on changes."
+)
+@click.argument("rev_range", metavar="RANGE", required=True)
+def impacted(rev_range, changed_only):
+    """List the modules affected by changes in RANGE, dependencies first.
+
+    Affected are the modules containing changed paths (also within updated
+    submodules) and all modules depending on them. RANGE is `A..B`,
+    `A...B` (changes on B since it forked from A) or `A` (up to HEAD), eg.
+    `origin/master...HEAD` for the changes of a feature branch."""
+    top_level = _get_top_level()
+    old, new = _get_rev_range(rev_range)
+    try:
+        paths = _get_changed_paths(top_level, old, new)
+    except (OSError, subprocess.CalledProcessError):
+        click.get_current_context().fail("Invalid revision range: " + rev_range)
+    g = _get_graph()
+    changed = _get_changed_modules(g, paths)
+    if not changed_only:
+        changed |= get_descendants(g, changed)
+    _echo_sorted(g, changed)
+
+
+@graph.command()
+@click.option("--json", "as_json", is_flag=True, help="Print the plan as JSON.")
+@click.argument("modules", nargs=-1)
+def waves(modules, as_json):
+    """Plan installing MODULES (default all) and their dependencies in waves.
+
+    All modules of a wave only depend on modules of earlier waves and can be
+    installed in parallel. The critical path is the longest dependency chain:
+    its length, the number of waves, bounds the installation time."""
+    g = _get_graph()
+    for module in modules:
+        _check_module(g, module)
+    scope = set(modules) | get_ancestors(g, modules) if modules else set(g)
+    missing = sorted(m for m in scope if not g.nodes[m])
+    if missing:
+        click.secho(
+            "Not found, hence left out: " + ", ".join(missing), fg="yellow", err=True
+        )
+    try:
+        planned, critical_path = get_waves(g, scope - set(missing))
+    except DependencyCycle as e:
+        _exit_on_cycle(e)
+    if as_json:
+        click.echo(json.dumps({"waves": planned, "critical_path": critical_path}))
+        return
+    for i, wave in enumerate(planned, 1):
+        click.secho("Wave {} ({}): ".format(i, len(wave)), fg="green", nl=False)
+        click.echo(", ".join(wave))
+    click.secho("Critical path ({}): ".format(len(critical_path)), fg="green", nl=False)
+    click.echo(" > ".join(critical_path))
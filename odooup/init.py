@@ -98,7 +98,7 @@ def init(odoo_version, is_enterprise, project):
 
     if (
         project
-        and call_cmd("git rev-parse --is-inside-work-tree", exit_on_error=False)
+        and call_cmd(["git", "rev-parse", "--is-inside-work-tree"], exit_on_error=False)
         == "true"
     ):
         click.get_current_context().fail(
@@ -106,16 +106,19 @@ def init(odoo_version, is_enterprise, project):
         )
     elif project:
         call_cmd(
-            "git clone https://github.com/xoe-labs/dockery-odoo-scaffold.git {}".format(
-                project
-            )
+            [
+                "git",
+                "clone",
+                "https://github.com/xoe-labs/dockery-odoo-scaffold.git",
+                project,
+            ]
         )
         current_directory = os.getcwd()
         final_directory = os.path.join(current_directory, project)
         click.echo("Switching to: " + click.style(final_directory, fg="yellow"))
         os.chdir(final_directory)
-        call_cmd("git remote rename origin scaffold")
-        call_cmd("git branch --unset-upstream")
+        call_cmd(["git", "remote", "rename", "origin", "scaffold"])
+        call_cmd(["git", "branch", "--unset-upstream"])
 
     # Repo cloning
     for repo_url in additional_repos:
@@ -140,13 +143,20 @@ def init(odoo_version, is_enterprise, project):
             replace_in_file(files, rule["from"], rule["to"])
 
     # Git commit
-    call_cmd("git add .")
-    call_cmd('git commit -m "Customize Project"')
-
-    call_cmd("git config commit.template $(pwd)/.git-commit-template")
-    call_cmd("pre-commit install --hook-type pre-commit")
-    call_cmd("pre-commit install --hook-type commit-msg")
-    call_cmd("pre-commit install --install-hooks")
+    call_cmd(["git", "add", "."])
+    call_cmd(["git", "commit", "-m", "Customize Project"])
+
+    call_cmd(
+        [
+            "git",
+            "config",
+            "commit.template",
+            os.path.join(os.getcwd(), ".git-commit-template"),
+        ]
+    )
+    call_cmd(["pre-commit", "install", "--hook-type", "pre-commit"])
+    call_cmd(["pre-commit", "install", "--hook-type", "commit-msg"])
+    call_cmd(["pre-commit", "install", "--install-hooks"])
     click.echo(
         "Next, run: " + click.style("`cd {} && make info`".format(project), fg="yellow")
     )
@@ -22,20 +22,31 @@
 
 from __future__ import absolute_import, division
 
+import hashlib
+import itertools
+import os
+import queue
+import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 from future import standard_library
 
+from . import _process
+
 standard_library.install_aliases()
 
 
 BACKPORT_FLAG = "BACKPORT"
 BASE_BRANCHES = ["6.0", "6.1", "7.0", "8.0", "9.0", "10.0", "11.0", "12.0", "master"]
-PATCH_PREFIX = "{}/{}-".format
 PATCH_FORMAT = "{}/{}-{}".format
 BASE_FORMAT = "{}/{}".format
 COMPILED_FORMAT = "{}/compiled/{}".format
+COMPILED_INPUTS_TRAILER = "Compiled-Inputs"
+# Refs pushed at once (atomically), bounding a failed push's impact
+PUSH_CHUNK_SIZE = 50
 
 
 class Git(object):
@@ -52,6 +63,8 @@ class Git(object):
         self.upstream = upstream
         self.branches = branches or []
         self.head = None
+        self._refs = None
+        self._patches = None
         click.echo("==> Git-Dir: %s" % self.git_dir)
         click.echo("==> Remote: %s" % self.remote)
         if self.branches:
@@ -61,23 +74,54 @@ class Git(object):
         self.branches = self.branches + branches
         click.echo("==> Base-Branche(s): %s" % ",".join(self.branches))
 
-    def run(self, command):
-        """Execute git command in bash
+    def run(self, command, worktree=None):
+        """Execute git command
         :param list command: Git cmd to execute in self.git_dir
-        :return: String output of command executed.
+        :param str worktree: Execute in this linked worktree instead
+        :return: String output of command executed (None if it failed).
         """
-        cmd = ["git", "--git-dir=" + self.git_dir] + command
+        if worktree:
+            cmd = ["git", "-C", worktree] + command
+        else:
+            cmd = ["git", "--git-dir=" + self.git_dir] + command
+        click.echo(">>> " + " ".join(cmd))
         try:
-            click.echo(">>> " + " ".join(cmd))
-            res = subprocess.check_output(cmd)
+            res = _process.run(cmd, capture_stderr=False).output
         except subprocess.CalledProcessError:
             res = None
-        if isinstance(res, bytes):
-            res = res.decode("utf-8")
         if res:
             res = res.strip("\n")
         return res
 
+    def push(self, refspecs):
+        """Force push refspecs to self.remote, in chunks pushed atomically
+        :param list refspecs: [src:]dst refspecs, dst as branch or full ref
+        :return: dict {dst ref: None if pushed, else the reason it was not}
+        """
+        results = {}
+        for i in range(0, len(refspecs), PUSH_CHUNK_SIZE):
+            chunk = refspecs[i : i + PUSH_CHUNK_SIZE]
+            cmd = ["git", "--git-dir=" + self.git_dir, "push", "--porcelain"]
+            cmd += ["--atomic", "-f", self.remote] + chunk
+            click.echo(">>> " + " ".join(cmd))
+            output = _process.run(cmd, check=False, capture_stderr=False).output
+            # <flag> TAB <from>:<to> TAB <summary> (<reason>)
+            for line in output.split("\n"):
+                fields = line.split("\t")
+                if len(fields) == 3:
+                    dst = fields[1].rpartition(":")[2]
+                    results[dst] = fields[2] if fields[0] == "!" else None
+            for refspec in chunk:
+                dst = refspec.rpartition(":")[2]
+                if not dst.startswith("refs/"):
+                    dst = "refs/heads/" + dst
+                results.setdefault(dst, "not pushed")
+        self._invalidate_refs()
+        for dst, reason in sorted(results.items()):
+            if reason:
+                click.secho("PUSH: %s - Failed: %s" % (dst, reason), fg="red")
+        return results
+
     def _continue_or_abort(self, op):
         if click.confirm("Continue (or abort)?"):
             if self.run([op, "--continue"]) is None:
@@ -125,21 +169,39 @@ class Git(object):
         if sstr.startswith(prefix):
             return sstr[len(prefix) :]
 
-    def _get_remote_branches(self):
-        return [
-            b
-            for b in self.run(["branch", "-r"]).replace(" ", "").split("\n")
-            if b.startswith(self.remote)
-        ]
-
-    def _is_patch(self, branch, base=None):
-        base = [base] if base else self.branches
-
-        def _has_prefix(br, b):
-            return br.startswith(PATCH_PREFIX(self.remote, b))
-
-        if any(b for b in base if _has_prefix(branch, b)):
-            return True
+    def _load_refs(self):
+        """ Index all remote branches once, with one for-each-ref """
+        prefix = "refs/remotes/" + self.remote + "/"
+        res = self.run(["for-each-ref", "--format=%(objectname) %(refname)", prefix])
+        self._refs = {}
+        self._patches = {}
+        for line in (res or "").split("\n"):
+            if not line:
+                continue
+            sha, _, ref = line.partition(" ")
+            name = ref[len(prefix) :]
+            if name == "HEAD":
+                continue
+            self._refs[self.remote + "/" + name] = sha
+
+    def _invalidate_refs(self):
+        """ Reload the refs index on next use (eg. after a push) """
+        self._refs = None
+        self._patches = None
+
+    def _get_refs(self):
+        """ {remote branch: sha}, from the refs index """
+        if self._refs is None:
+            self._load_refs()
+        return self._refs
+
+    def _get_patches(self, base):
+        """ The patch branches (<base>-<patch>) of base, from the refs index """
+        refs = self._get_refs()
+        if base not in self._patches:
+            prefix = self.remote + "/" + base + "-"
+            self._patches[base] = sorted(b for b in refs if b.startswith(prefix))
+        return list(self._patches[base])
 
     def update_remote(self):
         """ Updates odoo-dev remote from tracked remote branches """
@@ -153,45 +215,138 @@ class Git(object):
             self.run(["pull", self.upstream, branch + ":" + branch])
             click.secho("UPDATE: %s - Pushing base-branch ..." % branch, fg="green")
             self.run(["push", self.remote, branch + ":" + branch])
+        self._invalidate_refs()
 
-    def rebase_patches(self, patchname=None):
+    def rebase_patches(self, patchname=None, jobs=1):
         click.secho("REBASE: Rebasing patch branches ...", bg="cyan", fg="white")
         if patchname:
             to_rebase = {
                 b: [PATCH_FORMAT(self.remote, b, patchname)] for b in self.branches
             }
         else:
-            to_rebase = {b: [] for b in self.branches}
-            for br in self._get_remote_branches():
-                for base_branch in to_rebase.keys():
-                    if self._is_patch(br, base_branch):
-                        to_rebase[base_branch].append(br)
+            to_rebase = {b: self._get_patches(b) for b in self.branches}
+        if jobs > 1:
+            self._rebase_patches_in_worktrees(to_rebase, jobs)
+        else:
+            self._rebase_patches(to_rebase)
+
+    def _rebase_patches(self, to_rebase):
+        refspecs = []
         for base_branch, candidates in to_rebase.items():
             for candidate in candidates:
                 click.secho("REBASE: %s - Rebasing branch ..." % candidate, fg="cyan")
                 staging_name = self._get_staging_name(candidate)
                 self.checkout(candidate, staging_name)
                 if self.rebase(staging_name, base_branch):
-                    click.secho("REBASE: %s - Pushing ..." % candidate, fg="cyan")
-                    self.run(["push", "-f", self.remote])
+                    sha = self.run(["rev-parse", staging_name])
+                    refspecs.append("%s:refs/heads/%s" % (sha, staging_name))
                 self.checkout(base_branch)
                 self.run(["branch", "-D", staging_name])
+        if refspecs:
+            click.secho("REBASE: Pushing %s branches ..." % len(refspecs), fg="cyan")
+            self.push(refspecs)
+
+    def _rebase_in_worktree(self, worktree, candidate, base_branch):
+        """ Rebase candidate (detached) in worktree, aborting on conflicts
+        :return: tuple (sha of the rebased candidate (None if it failed),
+                 whether it conflicted)
+        """
+        if self.run(["checkout", "-q", "--detach", candidate], worktree) is None:
+            click.secho("REBASE: %s - Checkout failed" % candidate, fg="red")
+            return None, False
+        if self.run(["rebase", "-q", base_branch], worktree) is None:
+            self.run(["rebase", "--abort"], worktree)
+            return None, True
+        return self.run(["rev-parse", "HEAD"], worktree), False
+
+    def _add_worktrees(self, tmp_dir, count, commit):
+        """ Add up to count worktrees in tmp_dir, reporting failed ones
+        :return: list of the added worktrees
+        """
+        added = []
+        for i in range(count):
+            worktree = os.path.join(tmp_dir, str(i))
+            cmd = ["worktree", "add", "-q", "--detach", worktree, commit]
+            if self.run(cmd) is None:
+                click.secho("REBASE: Adding worktree %s failed" % worktree, fg="red")
+                continue
+            added.append(worktree)
+        return added
+
+    def _rebase_patches_in_worktrees(self, to_rebase, jobs):
+        """ Rebase concurrently, each job in a worktree of its own
+
+        Consecutive checkouts of patch branches in a worktree only touch the
+        files they differ in. Successful rebases are pushed at once, conflicts
+        are reported and can be resolved interactively afterwards. Without any
+        worktree, patches are rebased one by one in place.
+        """
+        tasks = [(c, b) for b, candidates in to_rebase.items() for c in candidates]
+        if not tasks:
+            return
+        tmp_dir = tempfile.mkdtemp(prefix="odooup-rebase-")
+        worktrees = queue.Queue()
+        for worktree in self._add_worktrees(
+            tmp_dir, min(jobs, len(tasks)), tasks[0][0]
+        ):
+            worktrees.put(worktree)
+        if worktrees.empty():
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            click.secho("REBASE: No worktree, rebasing in place ...", fg="yellow")
+            self._rebase_patches(to_rebase)
+            return
+
+        def _rebase(task):
+            worktree = worktrees.get()
+            try:
+                return self._rebase_in_worktree(worktree, *task)
+            finally:
+                worktrees.put(worktree)
+
+        try:
+            with ThreadPoolExecutor(max_workers=worktrees.qsize()) as executor:
+                rebased = dict(zip(tasks, executor.map(_rebase, tasks)))
+        finally:
+            while not worktrees.empty():
+                self.run(["worktree", "remove", "--force", worktrees.get()])
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            self.run(["worktree", "prune"])
+
+        refs = self._get_refs()
+        refspecs = [
+            "%s:refs/heads/%s" % (sha, self._get_staging_name(candidate))
+            for (candidate, _), (sha, _) in sorted(rebased.items())
+            if sha and sha != refs.get(candidate)
+        ]
+        if refspecs:
+            click.secho("REBASE: Pushing %s branches ..." % len(refspecs), fg="cyan")
+            self.push(refspecs)
+
+        conflicts = {}
+        for (candidate, base_branch), (_, conflicted) in sorted(rebased.items()):
+            if conflicted:
+                conflicts.setdefault(base_branch, []).append(candidate)
+                click.secho(
+                    "REBASE: %s - Conflicts with %s" % (candidate, base_branch),
+                    fg="red",
+                )
+        if conflicts and click.confirm("Resolve conflicting rebases interactively?"):
+            self._rebase_patches(conflicts)
 
     def backport_patches(self, name=None):
         click.secho("BACKPORT: Backporting patch branches ...", bg="cyan", fg="white")
 
         series = sorted(self.branches)
         while len(series) >= 2:
-            remote_branches = self._get_remote_branches()
             from_series = series.pop()
             to_series = series[-1]
-            to_backport = []
-            for br in remote_branches:
-                if name and not br.endswith(name):
-                    continue
-                if self._is_patch(br, from_series):
-                    to_backport.append(br)
+            to_backport = [
+                br
+                for br in self._get_patches(from_series)
+                if not name or br.endswith(name)
+            ]
 
+            refspecs = []
             for backport in to_backport:
                 click.secho(
                     "BACKPORT: %s - Backporting branch ..." % backport, fg="cyan"
@@ -201,10 +356,18 @@ class Git(object):
                 staging_backport_name = self._get_staging_name(backport_name)
                 self.checkout(self.remote + "/" + to_series, staging_backport_name)
                 if self.cherry_pick(commits):
-                    click.secho("BACKPORT: %s - Pushing ..." % backport_name, fg="cyan")
-                    self.run(["push", "-f", "-u", self.remote, staging_backport_name])
+                    sha = self.run(["rev-parse", staging_backport_name])
+                    refspecs.append("%s:refs/heads/%s" % (sha, staging_backport_name))
                 self.checkout(to_series)
                 self.run(["branch", "-D", staging_backport_name])
+            # Backported patches are candidates for backporting further
+            if refspecs:
+                click.secho(
+                    "BACKPORT: Pushing %s branches to %s ..."
+                    % (len(refspecs), to_series),
+                    fg="cyan",
+                )
+                self.push(refspecs)
 
     def backport_patch(self, refspec, target, name):
         candidate = self.remote + "/-" + name
@@ -218,32 +381,146 @@ class Git(object):
                 ),
                 fg="cyan",
             )
-            self.run(["push", "-f", "-u", self.remote, staging_backport_name])
+            sha = self.run(["rev-parse", staging_backport_name])
+            self.push(["%s:refs/heads/%s" % (sha, staging_backport_name)])
         self.checkout(target)
         self.run(["branch", "-D", staging_backport_name])
 
+    def _get_compile_inputs(self, base, patches):
+        """ Fingerprint of the heads of base and patches
+
+        The merge order follows from these heads, hence they are fingerprinted
+        sorted: up to date series are skipped before ordering their patches.
+        """
+        refs = self._get_refs()
+        heads = [base] + sorted(patches)
+        inputs = "\n".join("%s %s" % (br, refs.get(br)) for br in heads)
+        return hashlib.sha1(inputs.encode("utf-8")).hexdigest()
+
+    def _get_compiled_inputs(self, compiled):
+        """ The inputs fingerprint recorded on a compiled branch (if any) """
+        prefix = COMPILED_INPUTS_TRAILER + ": "
+        message = self.run(["log", "-1", "--format=%B", compiled]) or ""
+        for line in message.split("\n"):
+            if line.startswith(prefix):
+                return line[len(prefix) :]
+
+    def _merge_tree(self, head, branch):
+        """ Merge branch into head in the object database only (git >= 2.38)
+        :return: tree of the merge (None on conflicts or if not supported)
+        """
+        res = self.run(["merge-tree", "--write-tree", "--no-messages", head, branch])
+        return res.split("\n")[0] if res else None
+
+    def _compile_interactively(self, start, patches, staging_name, base_branch, inputs):
+        self.checkout(start, staging_name)
+        merged = True
+        for br in patches:
+            click.secho("COMPILE: Merging %s ..." % br, fg="blue")
+            merged = self.merge(br) and merged
+        if merged:
+            # Record the inputs on the last merge, as the tree-level merges do
+            message = self.run(["log", "-1", "--format=%B", "HEAD"])
+            message += "\n\n%s: %s" % (COMPILED_INPUTS_TRAILER, inputs)
+            self.run(["commit", "--amend", "--no-verify", "-m", message])
+        click.secho("COMPILE: Pushing (-f) syntetic of %s ..." % base_branch, fg="blue")
+        self.push([staging_name])
+        self.checkout(base_branch)
+        self.run(["branch", "-D", staging_name])
+
+    def _compile(self, base_branch, patches, staging_name, inputs):
+        """ Compile with tree-level merges, without touching the working tree
+
+        Falls back to merging interactively in the working tree from the
+        first conflicting patch on.
+        """
+        head = self._get_refs().get(BASE_FORMAT(self.remote, base_branch))
+        if not head:
+            click.get_current_context().fail("Unknown base branch. Aborting.")
+        for i, br in enumerate(patches):
+            click.secho("COMPILE: Merging %s ..." % br, fg="blue")
+            tree = self._merge_tree(head, br)
+            if tree is None:
+                click.secho("COMPILE: Conflicts, merging interactively ...", fg="blue")
+                self._compile_interactively(
+                    head, patches[i:], staging_name, base_branch, inputs
+                )
+                return
+            message = "Merge branch '%s' into %s" % (br, staging_name)
+            if br == patches[-1]:
+                message += "\n\n%s: %s" % (COMPILED_INPUTS_TRAILER, inputs)
+            head = self.run(["commit-tree", tree, "-p", head, "-p", br, "-m", message])
+            if head is None:
+                click.get_current_context().fail(
+                    "Committing the merge of %s failed. Aborting." % br
+                )
+        click.secho("COMPILE: Pushing (-f) syntetic of %s ..." % base_branch, fg="blue")
+        self.push(["%s:refs/heads/%s" % (head, staging_name)])
+
+    def _get_touched_paths(self, base, branch):
+        """ Paths branch changed since it forked from base """
+        res = self.run(["diff", "--name-only", base + "..." + branch])
+        return set(res.split("\n")) if res else set()
+
+    def _order_patches(self, base, patches):
+        """ Order patches for merging and predict conflicts between them
+
+        Patches touching the same paths likely conflict. Patches not
+        overlapping any other are merged first, the overlapping ones then
+        follow grouped by connected component of the overlap graph.
+
+        :return: tuple (ordered patches, {(patch, patch): shared paths})
+        """
+        owners = {}
+        for br in patches:
+            for path in self._get_touched_paths(base, br):
+                owners.setdefault(path, []).append(br)
+        overlaps = {}
+        neighbours = {br: set() for br in patches}
+        for path, brs in owners.items():
+            for pair in itertools.combinations(sorted(brs), 2):
+                overlaps.setdefault(pair, set()).add(path)
+                neighbours[pair[0]].add(pair[1])
+                neighbours[pair[1]].add(pair[0])
+
+        ordered = [br for br in patches if not neighbours[br]]
+        for br in patches:
+            if br in ordered:
+                continue
+            component = [br]
+            for member in component:
+                component += sorted(neighbours[member] - set(component))
+            ordered += component
+        return ordered, overlaps
+
     def compile(self):
         click.secho(
             "COMPILE: Compiling syntetic patch branches ...", bg="blue", fg="white"
         )
         for base_branch in self.branches:
-            staging_name = self._get_staging_name(
-                COMPILED_FORMAT(self.remote, base_branch)
-            )
-            self.checkout(BASE_FORMAT(self.remote, base_branch), staging_name)
+            compiled = COMPILED_FORMAT(self.remote, base_branch)
+            staging_name = self._get_staging_name(compiled)
             click.secho(
                 "COMPILE: Preparing syntetic of %s ..." % base_branch, fg="blue"
             )
-            for br in self._get_remote_branches():
-                if self._is_patch(br, base_branch):
-                    click.secho("COMPILE: Merging %s ..." % br, fg="blue")
-                    self.merge(br)
-            click.secho(
-                "COMPILE: Pushing (-f) syntetic of %s ..." % base_branch, fg="blue"
-            )
-            self.run(["push", "-f", self.remote, staging_name])
-            self.checkout(base_branch)
-            self.run(["branch", "-D", staging_name])
+            base = BASE_FORMAT(self.remote, base_branch)
+            patches = self._get_patches(base_branch)
+            inputs = self._get_compile_inputs(base, patches)
+            if compiled in self._get_refs() and (
+                self._get_compiled_inputs(compiled) == inputs
+            ):
+                click.secho(
+                    "COMPILE: Syntetic of %s is up to date." % base_branch, fg="blue"
+                )
+                continue
+            patches, overlaps = self._order_patches(base, patches)
+            for (br, other), paths in sorted(overlaps.items()):
+                click.secho(
+                    "COMPILE: %s and %s might conflict (touching %s)"
+                    % (br, other, ", ".join(sorted(paths))),
+                    fg="yellow",
+                )
+            self._compile(base_branch, patches, staging_name, inputs)
 
     def get_branch_name(self):
         """Get branch name
@@ -280,6 +557,15 @@ def patches(ctx, git_dir, origin, upstream):
     help="Update origin from tracking branches.",
 )
 @click.option("--rebase/--no-rebase", "-r", default=False, help="Rebase patches.")
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of patches to rebase concurrently, each in a worktree of its "
+    "own. Conflicts are collected and reported instead of resolved in place.",
+)
 @click.option(
     "--compile/--no-compile",
     "-c",
@@ -292,7 +578,7 @@ def patches(ctx, git_dir, origin, upstream):
 )
 @click.argument("branches", nargs=-1, required=True)
 @click.pass_context
-def maintain(ctx, update, rebase, compile_branch, auto, branches):
+def maintain(ctx, update, rebase, jobs, compile_branch, auto, branches):
     """ Run maintenance operations on remote development repository.
     """
     git = ctx.obj["GIT"]
@@ -305,7 +591,7 @@ def maintain(ctx, update, rebase, compile_branch, auto, branches):
             )
         git.update_remote()
     if rebase or auto:
-        git.rebase_patches()
+        git.rebase_patches(jobs=jobs)
     if compile_branch or auto:
         git.compile()
 
@@ -1,11 +1,19 @@
+import hashlib
+import json
 import os
+import shutil
+import tempfile
 
 import click
-import networkx
-from networkx import ancestors, bidirectional_shortest_path, dag_longest_path, subgraph
 
-from ._helpers import call_cmd, get_fs_target
-from ._modulegraph import get_graph
+from ._helpers import DEFAULT_JOBS, call_cmd, get_fs_target
+from ._modulegraph import (
+    GRAPH_BACKENDS,
+    DependencyCycle,
+    get_closures,
+    get_descendants,
+    get_graph,
+)
 
 DOCKERIGNORE_PLACEHOLDER = "# Autogenerated file content from here ... DO NOT MODIFY"
 
@@ -20,54 +28,184 @@ def _get_ns_from_sparse_persistence_file(ns_path):
     return os.path.join(os.path.dirname(path), os.path.basename(path)[8:])
 
 
-def _get_sparse_file(ns):
+def _get_repo(ns):
+    """ Top level of the repo holding namespace ns (which a sparse checkout
+    might have removed), None if there is none """
+    path = ns
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    top_level = call_cmd(
+        ["git", "rev-parse", "--show-toplevel"],
+        echo_cmd=False,
+        exit_on_error=False,
+        cwd=path,
+    )
+    return top_level if top_level != "ERROR" else None
+
+
+def _get_sparse_file(repo):
     git_path = call_cmd(
-        "git rev-parse --git-dir", echo_cmd=False, exit_on_error=False, cwd=ns
+        ["git", "rev-parse", "--git-dir"], echo_cmd=False, exit_on_error=False, cwd=repo
     )
-    return os.path.join(git_path, "info", "sparse-checkout")
+    return os.path.join(repo, git_path, "info", "sparse-checkout")
 
 
-def _symlink_sparse_file(ns):
+def _symlink_sparse_file(ns, sparse_file):
     ns_path = _get_sparse_persistence_file(ns)
-    sparse_file = _get_sparse_file(ns)
-    call_cmd(
-        "ln -s {ns_path} {sparse_file}".format(**locals()), exit_on_error=False, cwd=ns
+    # Replace patterns written in place of the link
+    if os.path.isfile(sparse_file) and not os.path.islink(sparse_file):
+        os.remove(sparse_file)
+    try:
+        os.symlink(ns_path, sparse_file)
+    except OSError:  # Already linked
+        pass
+
+
+def _write_sparse_file(sparse_file, lines):
+    # Never write through the link to a persistence file
+    if os.path.islink(sparse_file):
+        os.remove(sparse_file)
+    with open(sparse_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def _is_cone_compatible(lines):
+    """ Whether all patterns are plain module names (besides !setup/**) """
+    return all(
+        not any(c in line for c in "/*?[!\\")
+        for line in lines
+        if line and line != "!setup/**"
     )
 
 
-def _log_longest_path_per_module(module, g, deps):
-    sub = subgraph(g, deps)
+def _get_modules(lines):
+    return {line for line in lines if line and line != "!setup/**"}
+
+
+def _get_cone_patterns(modules_by_prefix):
+    """ Cone mode patterns checking out the modules of each prefix (relative
+    to the repo root), all files of the parent directories and nothing else
+
+    Top-level directories (like setup/) are left out as a matter of course.
+    """
+    # {directory: whether only its files are checked out}
+    dirs = {}
+    for prefix, modules in modules_by_prefix.items():
+        parent = "/"
+        for part in filter(None, prefix.split("/")):
+            parent += part + "/"
+            dirs[parent] = True
+        for module in modules:
+            dirs.setdefault(parent + module + "/", False)
+    patterns = ["/*", "!/*/"]
+    # Parents sort before their subdirectories, as cone mode requires
+    for directory in sorted(dirs):
+        patterns.append(directory)
+        if dirs[directory]:
+            patterns.append("!" + directory + "*/")
+    return patterns
+
+
+def _log_longest_path_per_module(module, g, closure):
     predecessors = set(g.predecessors(module))
     click.secho(module + ": ", fg="green", bold=True, nl=False)
     click.secho(", ".join(predecessors), fg="yellow")
+    if closure.shortest:
+        click.secho("Shortest: " + " > ".join(closure.shortest), fg="white")
+    # The longest path among the dependencies, leading to module
+    click.secho("Longest:  " + " > ".join(closure.longest[:-1]), fg="white")
     click.secho(
-        "Shortest: " + " > ".join(bidirectional_shortest_path(g, "base", module)),
+        "All Deps: " + ", ".join(sorted(list(closure.deps - predecessors))),
         fg="white",
     )
-    click.secho("Longest:  " + " > ".join(dag_longest_path(sub)), fg="white")
-    click.secho("All Deps: " + ", ".join(sorted(list(deps - predecessors))), fg="white")
 
 
-def ensure_sparse_checkouts(rootpath):
-    for root, _, files in os.walk(rootpath):
-        for file in files:
-            if file.startswith(".sparse-"):
-                ns = os.path.join(root, file[8:])
-                _symlink_sparse_file(ns)
-                call_cmd(
-                    "git config core.sparseCheckout True", exit_on_error=False, cwd=ns
-                )
-                call_cmd("rm -rf *", exit_on_error=False, cwd=ns)
-                call_cmd("git reset --hard HEAD", exit_on_error=False, cwd=ns)
+def _find_sparse_files(rootpath):
+    """ Sparse persistence files of the namespaces of rootpath's modules
 
+    Namespaces come from the scanned module graph, so that namespaces nested
+    deep inside a submodule (like vendor/odoo/cc/odoo/addons) are found, too.
+    """
+    return _get_all_sparse_files(get_graph(rootpath), rootpath)
 
-def _get_all_sparse_files(g):
+
+def _get_sparse_files_by_repo(sparse_files):
+    """ {repo top level: {namespace: sparse persistence file}} """
+    repos = {}
+    for ns_path in sorted(sparse_files):
+        ns = os.path.join(
+            os.path.dirname(ns_path), os.path.basename(ns_path)[len(".sparse-") :]
+        )
+        repo = _get_repo(ns)
+        if repo is None:
+            click.secho(
+                "SPARSE CHECKOUT: {} is not within a repo, skipping.".format(ns),
+                fg="yellow",
+            )
+            continue
+        repos.setdefault(repo, {})[ns] = ns_path
+    return repos
+
+
+def ensure_sparse_checkouts(rootpath, sparse_files=None, cone=False, changed=None):
+    """ (Re)apply sparse checkouts, by default of all sparse persistence files
+    found for rootpath's namespaces
+
+    A repo has one sparse checkout for all of its namespaces (like addons/
+    and odoo/addons/ of odoo), written from the union of their persistence
+    files. A repo's only namespace keeps linking its persistence file as is,
+    unless with cone all its namespaces list plain module names: these get
+    cone mode patterns. With changed, only the repos holding any of these
+    persistence files are reapplied.
+
+    Patterns are applied by `git read-tree -mu HEAD`, which only adds and
+    removes the paths whose inclusion changed.
+    """
+    if sparse_files is None:
+        sparse_files = _find_sparse_files(rootpath)
+    for repo, namespaces in sorted(_get_sparse_files_by_repo(sparse_files).items()):
+        if changed is not None and not set(namespaces.values()) & set(changed):
+            continue
+        sparse = {ns: _read_sparse_file(ns) for ns in namespaces}
+        use_cone = cone and all(_is_cone_compatible(lines) for lines in sparse.values())
+        sparse_file = _get_sparse_file(repo)
+        if use_cone:
+            real_repo = os.path.realpath(repo)
+            modules_by_prefix = {
+                os.path.relpath(os.path.realpath(ns), real_repo): _get_modules(lines)
+                for ns, lines in sparse.items()
+            }
+            _write_sparse_file(sparse_file, _get_cone_patterns(modules_by_prefix))
+        elif len(sparse) == 1:
+            _symlink_sparse_file(list(sparse)[0], sparse_file)
+        else:
+            # Module names match within all namespaces of the repo alike
+            lines = []
+            for ns in sorted(sparse):
+                lines += sorted(sparse[ns] - set(lines) - {""})
+            # Exclusions (like !setup/**) must follow all inclusions
+            lines.sort(key=lambda line: line.startswith("!"))
+            _write_sparse_file(sparse_file, lines)
+        call_cmd(
+            ["git", "config", "core.sparseCheckout", "True"],
+            exit_on_error=False,
+            cwd=repo,
+        )
+        call_cmd(
+            ["git", "config", "core.sparseCheckoutCone", str(use_cone).lower()],
+            exit_on_error=False,
+            cwd=repo,
+        )
+        call_cmd(["git", "read-tree", "-mu", "HEAD"], exit_on_error=False, cwd=repo)
+
+
+def _get_all_sparse_files(g, rootpath=""):
     sparse_files = set()
     for module in g:
-        node = g.node[module]
+        node = g.nodes[module]
         if not node:
             continue
-        ns = node["namespace"]
+        ns = os.path.join(rootpath, node["namespace"])
         ns_path = _get_sparse_persistence_file(ns)
         if os.path.isfile(ns_path):
             sparse_files |= {ns_path}
@@ -76,7 +214,7 @@ def _get_all_sparse_files(g):
 
 def _warn_missing_dependencies(g, rootpath):
     for module in g:
-        node = g.node[module]
+        node = g.nodes[module]
         if not node:
             succ = g.successors(module)
             click.secho(
@@ -87,14 +225,22 @@ def _warn_missing_dependencies(g, rootpath):
             )
 
 
+def _read_sparse_file(ns):
+    """ The lines of a namespace's sparse persistence file, None if it has none """
+    ns_path = _get_sparse_persistence_file(ns)
+    if not os.path.isfile(ns_path):
+        return None
+    with open(ns_path, "r") as f:
+        return set(f.read().splitlines())
+
+
 def _write_to_sparse_file(ns, include, must_exist=True):
     ns_path = _get_sparse_persistence_file(ns)
-    existing = set()
-    if os.path.isfile(ns_path):
-        with open(ns_path, "r") as f:
-            existing = set(f.read().splitlines())
-    elif must_exist:
-        return False
+    existing = _read_sparse_file(ns)
+    if existing is None:
+        if must_exist:
+            return False
+        existing = set()
     if not include - existing:
         return False
 
@@ -103,70 +249,211 @@ def _write_to_sparse_file(ns, include, must_exist=True):
     if "!setup/**" in should:
         should.remove("!setup/**")
     with open(ns_path, "w") as f:
-        f.write("\n".join(should) + "\n!setup/**\n")
+        f.write("\n".join(sorted(should)) + "\n!setup/**\n")
     return True
 
 
-def _reconcile_auto_install(g):
-    all_sparse_files = _get_all_sparse_files(g)
-    all_white_listed = []
+def _get_state_path(rootpath):
+    git_dir = call_cmd(["git", "rev-parse", "--git-dir"], echo_cmd=False, cwd=rootpath)
+    return os.path.join(rootpath, git_dir, "odooup-whitelist.json")
+
+
+def _load_state(rootpath):
+    """ The state recorded by the last whitelist run of all src modules """
+    try:
+        with open(_get_state_path(rootpath), "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _save_state(rootpath, g, sparse_state, cone, skip_native):
+    state = {
+        "manifests": _get_manifest_state(g),
+        "sparse": sparse_state,
+        "cone": cone,
+        "skip_native": skip_native,
+    }
+    with open(_get_state_path(rootpath), "w") as f:
+        json.dump(state, f, sort_keys=True)
+
+
+def _get_manifest_state(g):
+    return {
+        module: [g.nodes[module]["namespace"], g.nodes[module]["manifest_object"]]
+        for module in g
+        if g.nodes[module]
+    }
+
+
+def _get_sparse_state(g):
+    """ {sparse persistence file: hash of its content} """
+    sparse_state = {}
+    for f_path in _get_all_sparse_files(g):
+        with open(f_path, "rb") as f:
+            sparse_state[f_path] = hashlib.sha1(f.read()).hexdigest()
+    return sparse_state
+
+
+def _get_affected_src_modules(g, state):
+    """ src modules whose dependency closure changed since state was recorded
+
+    Changed are modules added, removed since or whose manifest or namespace
+    differs. Removed modules still depended upon remain dependency-only nodes.
+    """
+    recorded = state["manifests"]
+    current = _get_manifest_state(g)
+    changed = {
+        module
+        for module, manifest_state in current.items()
+        if recorded.get(module) != manifest_state
+    }
+    changed |= {module for module in recorded if module not in current}
+    affected = changed | get_descendants(g, [m for m in changed if m in g])
+    return {
+        module
+        for module in affected
+        if module in g and g.nodes[module] and "src" in g.nodes[module]["namespace"]
+    }
+
+
+def _get_white_listed(g):
+    """ Read every namespace's sparse persistence file once
+
+    :return: tuple ({namespace: lines or None}, whitelisted modules,
+        auto_install modules)
+    """
+    sparse = {}
+    white_listed = set()
     auto_install = []
     for module in g:
-        node = g.node[module]
+        node = g.nodes[module]
         if not node:
             continue
         ns = node["namespace"]
-        ns_path = _get_sparse_persistence_file(ns)
-        if not os.path.isfile(ns_path):
-            all_white_listed.append(module)
+        if ns not in sparse:
+            sparse[ns] = _read_sparse_file(ns)
+        if sparse[ns] is None:
+            white_listed.add(module)
         if node["manifest"].get("auto_install"):
             auto_install.append(module)
+    for lines in sparse.values():
+        white_listed |= lines or set()
+    return sparse, white_listed, auto_install
 
-    for f_path in all_sparse_files:
-        with open(f_path, "r") as f:
-            all_white_listed.extend(f.read().splitlines())
 
-    state_change = False
+def _reconcile_auto_install(g):
+    """ Whitelist auto_install modules whose dependencies all are whitelisted
+
+    A worklist fixpoint: auto_install modules are indexed by the dependencies
+    they still wait for and only re-checked once one of those got whitelisted
+    itself. Modules of namespaces without sparse persistence file are checked
+    out in full, hence whitelisted already.
+
+    :return: dict {module: its dependencies} of the auto-added modules
+    """
+    sparse, white_listed, auto_install = _get_white_listed(g)
+    waiting = {}
+    missing = {}
+    worklist = []
     for module in auto_install:
-        node = g.node[module]
-        if not node:
-            continue
-        deps = node["manifest"].get("depends", [])
-        if not all(dep in all_white_listed for dep in deps):
+        if module in white_listed:
             continue
+        missing[module] = set(g.nodes[module]["manifest"].get("depends", []))
+        missing[module] -= white_listed
+        for dep in missing[module]:
+            waiting.setdefault(dep, []).append(module)
+        if not missing[module]:
+            worklist.append(module)
+
+    added = {}
+    while worklist:
+        module = worklist.pop()
+        node = g.nodes[module]
+        added[module] = node["manifest"].get("depends", [])
+        white_listed.add(module)
+        sparse[node["namespace"]].add(module)
+        for waiter in waiting.pop(module, []):
+            missing[waiter].discard(module)
+            if not missing[waiter]:
+                worklist.append(waiter)
+
+    for module in sorted(added):
+        click.secho("AUTO INSTALL: ", fg="green", bold=True, nl=False)
+        click.secho(
+            "{} (all of {} whitelisted)".format(module, ", ".join(added[module])),
+            fg="yellow",
+        )
+    include = {}
+    for module in added:
+        include.setdefault(g.nodes[module]["namespace"], set()).add(module)
+    for ns in include.keys():
+        _write_to_sparse_file(ns, include[ns])
+    return added
 
-        # If no sparse-persistence file exists, no need to whitelist, either.
-        ns = node["namespace"]
-        state_change = _write_to_sparse_file(ns, {module})
-    return state_change
 
+def _get_dockerignore_lines(g, compact=False):
+    """ The generated .dockerignore section, in a deterministic order
 
-def ensure_dockerignore_updated(g):
-    all_sparse_files = _get_all_sparse_files(g)
-    dockerignore_snippet = ""
-    for file in all_sparse_files:
+    Per namespace, everything is ignored but its whitelisted modules. With
+    compact, namespaces listing plain module names only ignore their other
+    modules and setup instead: without negated patterns, the docker daemon
+    can skip ignored directories as a whole when scanning the build context.
+    """
+    addons = {}
+    for module in g:
+        if g.nodes[module]:
+            addons.setdefault(g.nodes[module]["namespace"], set()).add(module)
+    for file in _get_all_sparse_files(g):
         ns = _get_ns_from_sparse_persistence_file(file)
-        ignore = [os.path.join(ns, "**")]
         with open(file, "r") as f:
             existing = set(f.read().splitlines())
-        less = ["!" + os.path.join(ns, l) for l in existing if "!setup" not in l]
-        dockerignore_snippet += "\n".join(ignore + sorted(less)) + "\n"
+        less = {line for line in existing if line and "!setup" not in line}
+        if compact and _is_cone_compatible(existing):
+            for module in sorted(addons.get(ns, set()) - less) + ["setup"]:
+                yield os.path.join(ns, module)
+        else:
+            yield os.path.join(ns, "**")
+            for line in sorted(less):
+                yield "!" + os.path.join(ns, line)
 
-    with open(".dockerignore", "r") as f:
-        lines = f.read().splitlines()
 
-    with open(".dockerignore", "w") as f:
-        for line in lines:
-            f.write(line + "\n")
-            if DOCKERIGNORE_PLACEHOLDER in line:
-                break
-        f.write(dockerignore_snippet)
+def ensure_dockerignore_updated(g, compact=False):
+    """ Regenerate the section after the placeholder in .dockerignore
+
+    The file is only (atomically) rewritten if its content changes, so that
+    docker's build context and layer cache are not invalidated needlessly.
 
+    :return: True if .dockerignore was written
+    """
+    with open(".dockerignore", "r") as f:
+        content = f.read()
+
+    should = ""
+    for line in content.splitlines():
+        should += line + "\n"
+        if DOCKERIGNORE_PLACEHOLDER in line:
+            break
+    for line in _get_dockerignore_lines(g, compact):
+        should += line + "\n"
+    if should == content:
+        return False
 
-def _handle_module(g, module, rootpath, skip_native):
+    fd, tmp_path = tempfile.mkstemp(dir=".", prefix=".dockerignore.")
     try:
-        deps = ancestors(g, module)
-    except networkx.exception.NetworkXError:
+        with os.fdopen(fd, "w") as f:
+            f.write(should)
+        shutil.copymode(".dockerignore", tmp_path)
+        os.rename(tmp_path, ".dockerignore")
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+
+def _check_module(g, module, rootpath, skip_native):
+    if module not in g:
         click.secho(
             "UNKNOWN MODULE: '{}' is not in the module graph built from "
             "{}.".format(module, rootpath),
@@ -175,7 +462,7 @@ def _handle_module(g, module, rootpath, skip_native):
         )
         click.get_current_context().exit(code=1)
 
-    node = g.node[module]
+    node = g.nodes[module]
     if not node:
         click.secho(
             "MISSING MODULE, BUT REFERENCED: While '{}' is itself listed as a "
@@ -186,23 +473,46 @@ def _handle_module(g, module, rootpath, skip_native):
         )
         click.get_current_context().exit(code=1)
 
-    _log_longest_path_per_module(module, g, deps)
-
     if skip_native and "vendor/odoo" in node["namespace"]:
         click.get_current_context().exit(
             "You have specified a native module while skipping native modules "
             "from whitelisting."
         )
 
-    # src folder modules should not be white listed
-    if "src" in node["namespace"]:
-        include = {}
-    else:
-        include = {node["namespace"]: {module}}
+
+def _handle_modules(g, modules, rootpath, skip_native, report=True):
+    """ Whitelist the dependency closures of all modules at once
+
+    Closures are computed in a single pass over the graph and includes are
+    grouped by namespace, so that each sparse file is written only once.
+    """
+    for module in modules:
+        _check_module(g, module, rootpath, skip_native)
+    try:
+        closures = get_closures(g, modules)
+    except DependencyCycle:
+        click.secho(
+            "DEPENDENCY CYCLE: The dependencies of {} are circular.".format(
+                ", ".join(sorted(modules))
+            ),
+            fg="red",
+            bold=True,
+        )
+        click.get_current_context().exit(code=1)
+
+    include = {}
+    for module in modules:
+        if report:
+            _log_longest_path_per_module(module, g, closures[module])
+        node = g.nodes[module]
+        # src folder modules should not be white listed
+        if "src" not in node["namespace"]:
+            include.setdefault(node["namespace"], set())
+            include[node["namespace"]] |= {module}
 
     fail = False
-    for dep in deps:
-        node = g.node[dep]
+    for dep in sorted(set().union(*(c.deps for c in closures.values()))):
+        node = g.nodes[dep]
         if not node:
             fail = True
             click.secho(
@@ -235,28 +545,87 @@ def _handle_module(g, module, rootpath, skip_native):
     prompt="Ignore native modules from sparse checkout config?",
     help="Excludes native modules form sparse checkout configuration.",
 )
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help="Reuse module graph data cached for unchanged commits.",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=1),
+    default=DEFAULT_JOBS,
+    show_default=True,
+    help="Number of submodules to scan concurrently.",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Only whitelist src modules affected by changes since the last run "
+    "and only re-apply sparse checkouts whose configuration changed.",
+)
+@click.option(
+    "--report/--no-report",
+    default=True,
+    help="Log the shortest and longest dependency path of every module.",
+)
+@click.option(
+    "--cone/--no-cone",
+    default=False,
+    help="Check out namespaces in (faster) cone mode, where their sparse "
+    "configuration allows for it. Requires git 2.25 or later.",
+)
+@click.option(
+    "--compact-dockerignore",
+    is_flag=True,
+    default=False,
+    help="Ignore the modules which are not whitelisted instead of all but "
+    "the whitelisted ones, avoiding negated patterns in .dockerignore.",
+)
+@click.option(
+    "--graph-backend",
+    type=click.Choice(GRAPH_BACKENDS),
+    default="compact",
+    show_default=True,
+    help="Module graph implementation (networkx must be installed for it).",
+)
 @click.argument("module", required=False)
-def whitelist(module, skip_native):
+def whitelist(
+    module,
+    skip_native,
+    cache,
+    jobs,
+    incremental,
+    report,
+    cone,
+    compact_dockerignore,
+    graph_backend,
+):
     """ Whitleist a module dependency tree for sparse checkout. If no module is
      specified, whitelist all depedencies of all modules listed in ./src."""
 
     # We are inside of a git
     if not (
         call_cmd(
-            "git rev-parse --is-inside-work-tree", exit_on_error=False, echo_cmd=False
+            ["git", "rev-parse", "--is-inside-work-tree"],
+            exit_on_error=False,
+            echo_cmd=False,
         )
         == "true"
     ):
         click.get_current_context().fail("You are not inside a work tree.")
 
     # Validate we are in the right folder (~/odoo/org/project)
-    repo_url = call_cmd("git config --local remote.origin.url", echo_cmd=False)
+    repo_url = call_cmd(
+        ["git", "config", "--local", "remote.origin.url"], echo_cmd=False
+    )
     if not repo_url:
         click.get_current_context().fail(
             "This project has no origin repo (yet). Please configure an origin "
             "first before continuing with white listing operations."
         )
-    top_level = call_cmd("git rev-parse --show-toplevel", echo_cmd=False)
+    top_level = call_cmd(["git", "rev-parse", "--show-toplevel"], echo_cmd=False)
     expected_path = get_fs_target(repo_url)
     if expected_path != top_level:
         click.get_current_context().fail(
@@ -271,22 +640,47 @@ def whitelist(module, skip_native):
         bold=True,
     )
     # Start white listing
-    g = get_graph(top_level)
+    g = get_graph(top_level, use_cache=cache, jobs=jobs, backend=graph_backend)
+    state = _load_state(top_level) if incremental else None
+    if state and state.get("skip_native") != skip_native:
+        # Native modules were (not) whitelisted, a full run catches up
+        click.secho(
+            "INCREMENTAL: Skipping native modules changed, running in full.",
+            fg="yellow",
+        )
+        state = None
     # If no module is set, whitelist based on src folder
     if not module:
-        for module in g:
-            node = g.node[module]
-            if "namespace" in node and "src" in node["namespace"]:
-                _handle_module(g, module, top_level, skip_native)
+        src_modules = [m for m in g if g.nodes[m] and "src" in g.nodes[m]["namespace"]]
+        if state:
+            affected = _get_affected_src_modules(g, state)
+            click.secho(
+                "INCREMENTAL: {} of {} src modules affected by changes since the "
+                "last run.".format(len(affected), len(src_modules)),
+                fg="green",
+            )
+            src_modules = [m for m in src_modules if m in affected]
+        _handle_modules(g, src_modules, top_level, skip_native, report)
     else:
-        _handle_module(g, module, top_level, skip_native)
-
-    while _reconcile_auto_install(g):
-        pass
-
-    ensure_sparse_checkouts(top_level)
+        _handle_modules(g, [module], top_level, skip_native, report)
+
+    _reconcile_auto_install(g)
+
+    sparse_state = _get_sparse_state(g)
+    if state and state.get("cone", False) == cone:
+        recorded = state["sparse"]
+        ensure_sparse_checkouts(
+            top_level,
+            list(sparse_state),
+            cone,
+            changed={f for f, d in sparse_state.items() if recorded.get(f) != d},
+        )
+    else:
+        ensure_sparse_checkouts(top_level, list(sparse_state), cone)
+    if not module:
+        _save_state(top_level, g, sparse_state, cone, skip_native)
 
-    ensure_dockerignore_updated(g)
+    ensure_dockerignore_updated(g, compact_dockerignore)
 
     _warn_missing_dependencies(g, top_level)
 
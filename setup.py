@@ -20,7 +20,13 @@ setup(
     use_scm_version=True,
     packages=find_packages(),
     setup_requires=["setuptools-scm"],
-    install_requires=["click>=7.0", "click-plugins", "future", "appdirs", "networkx"],
+    install_requires=[
+        "click>=7.0",
+        "future",
+        "appdirs",
+        "importlib-metadata; python_version<'3.8'",
+    ],
+    extras_require={"networkx": ["networkx"]},
     license="LGPLv3+",
     author="XOE Labs",
     author_email="info@xoe.solutions",
@@ -39,11 +45,5 @@ setup(
     entry_points="""
         [console_scripts]
         odooup=odooup.cli:main
-        [core_package.cli_plugins]
-        version=odooup.cli:version
-        init=odooup.init:init
-        patches=odooup.patches:patches
-        whitelist=odooup.whitelist:whitelist
-        clone=odooup.clone:clone
     """,
 )
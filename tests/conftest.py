@@ -0,0 +1,23 @@
+# Copyright 2019 XOE Labs (<https://xoe.solutions>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import subprocess
+
+import pytest
+
+
+def _git(cwd, *args):
+    return subprocess.check_output(
+        ("git",) + args, cwd=str(cwd), universal_newlines=True
+    ).strip()
+
+
+@pytest.fixture
+def run_git(monkeypatch):
+    """run_git(cwd, *args) runs git in cwd and returns its output, commits
+    (also those of odooup's git calls) are made as a test identity"""
+    for var in ("GIT_AUTHOR_NAME", "GIT_COMMITTER_NAME"):
+        monkeypatch.setenv(var, "odooup")
+    for var in ("GIT_AUTHOR_EMAIL", "GIT_COMMITTER_EMAIL"):
+        monkeypatch.setenv(var, "odooup@example.com")
+    return _git
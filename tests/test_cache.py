@@ -0,0 +1,68 @@
+# Copyright 2019 XOE Labs (<https://xoe.solutions>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import json
+import os
+import time
+
+from click.testing import CliRunner
+
+from odooup import cache
+from odooup._cache import ALL_BRANCHES, STATE_FILE, add_borrower, get_cache_dir
+
+DAY = 86400
+
+
+def _add_repo(name, state=None, fetch_head_age=0):
+    repo_cache_dir = get_cache_dir("github.com", "oca", name)
+    os.makedirs(os.path.join(repo_cache_dir, "objects"))
+    for ref in ("HEAD", "FETCH_HEAD"):
+        path = os.path.join(repo_cache_dir, ref)
+        open(path, "w").close()
+        mtime = time.time() - fetch_head_age
+        os.utime(path, (mtime, mtime))
+    if state is not None:
+        with open(os.path.join(repo_cache_dir, STATE_FILE), "w") as f:
+            json.dump(state, f)
+    return repo_cache_dir
+
+
+def test_prune(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    now = time.time()
+    _add_repo("used", {"used": now - DAY, "fetched": {ALL_BRANCHES: now - 100 * DAY}})
+    _add_repo("unused", {"used": now - 100 * DAY, "fetched": {ALL_BRANCHES: now - DAY}})
+    _add_repo("warmed", {"fetched": {ALL_BRANCHES: now - DAY}})
+    _add_repo("legacy", fetch_head_age=DAY)
+    _add_repo("legacy_stale", fetch_head_age=100 * DAY)
+
+    result = CliRunner().invoke(cache.cache, ["prune", "--dry-run"])
+    assert result.exit_code == 0
+    assert "oca/unused" in result.output
+    assert "oca/legacy_stale" in result.output
+    assert result.output.count("Evicting") == 2
+
+
+def test_prune_keeps_borrowed(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    stale = {"used": time.time() - 100 * DAY}
+    borrowed = _add_repo("borrowed", stale)
+    dissociated = _add_repo("dissociated", stale)
+    for name, repo_cache_dir in (("a", borrowed), ("b", dissociated)):
+        git_dir = tmp_path / "project" / name
+        (git_dir / "objects" / "info").mkdir(parents=True)
+        alternates = os.path.join(repo_cache_dir, "objects")
+        (git_dir / "objects" / "info" / "alternates").write_text(alternates + "\n")
+        add_borrower(repo_cache_dir, str(git_dir))
+    os.remove(str(tmp_path / "project" / "b" / "objects" / "info" / "alternates"))
+
+    result = CliRunner().invoke(cache.cache, ["prune"], input="n\n")
+    assert result.exit_code == 0
+    assert "Keeping github.com/oca/borrowed" in result.output
+    assert "Evicting github.com/oca/dissociated" in result.output
+    assert os.path.isdir(dissociated)
+
+    result = CliRunner().invoke(cache.cache, ["prune", "--force"])
+    assert result.exit_code == 0
+    assert os.path.isdir(borrowed)
+    assert not os.path.exists(dissociated)
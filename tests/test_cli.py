@@ -0,0 +1,27 @@
+# Copyright 2019 XOE Labs (<https://xoe.solutions>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+from odooup import main
+
+
+def tests_lazy_subcommands():
+    # A fresh interpreter, so that no other test imported subcommands before
+    code = (
+        "import sys; from click.testing import CliRunner; from odooup import main; "
+        "CliRunner().invoke(main, ['version']); "
+        "print('odooup.whitelist' in sys.modules, 'networkx' in sys.modules)"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code])
+    assert output.split() == [b"False", b"False"]
+
+
+def tests_help_lists_subcommands():
+    result = CliRunner().invoke(main, ["--help"])
+    assert result.exit_code == 0
+    for name in ("cache", "clone", "init", "patches", "version", "whitelist"):
+        assert "  " + name in result.output
@@ -0,0 +1,81 @@
+# Copyright 2019 XOE Labs (<https://xoe.solutions>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import pytest
+from click.testing import CliRunner
+
+from odooup import graph
+from odooup._modulegraph import ModuleGraph
+from odooup.graph import _get_changed_modules
+
+
+def test_get_changed_modules():
+    g = ModuleGraph()
+    g.add_module("web_a", "vendor/oca/web", None, {"depends": ["base"]})
+    g.add_module("web_ab", "vendor/oca/web", None, {"depends": ["web_a"]})
+    g.add_module("sale_x", "vendor/oca/sale", None, {"depends": ["web_a"]})
+    g.add_module("my_mod", "src", None, {"depends": ["sale_x"]})
+
+    paths = {"src/my_mod/models.py", "vendor/oca/web/web_a/README.rst", "README.md"}
+    assert _get_changed_modules(g, paths) == {"my_mod", "web_a"}
+    # Submodules which could not be diffed
+    assert _get_changed_modules(g, {"vendor/oca/web"}) == {"web_a", "web_ab"}
+
+
+@pytest.mark.parametrize("query", [["deps", "my_mod"], ["rdeps", "base"]])
+def test_queries_on_cycle(monkeypatch, query):
+    g = ModuleGraph()
+    g.add_module("base", "vendor/odoo/cc", None, {"depends": ["my_mod"]})
+    g.add_module("my_mod", "src", None, {"depends": ["base"]})
+    monkeypatch.setattr(graph, "_get_graph", lambda: g)
+
+    result = CliRunner().invoke(graph.graph, query)
+    assert result.exit_code == 1
+    assert "DEPENDENCY CYCLE" in result.output
+
+
+def test_impacted(monkeypatch):
+    g = ModuleGraph()
+    g.add_module("base", "vendor/odoo/cc", None, {"depends": ["my_mod"]})
+    g.add_module("my_mod", "src", None, {"depends": ["base"]})
+    monkeypatch.setattr(graph, "_get_graph", lambda: g)
+    monkeypatch.setattr(graph, "_get_top_level", lambda: ".")
+    monkeypatch.setattr(graph, "_get_rev_range", lambda r: ("A", "B"))
+    monkeypatch.setattr(graph, "_get_changed_paths", lambda *a: {"src/my_mod/a.py"})
+
+    # An empty default range (HEAD..HEAD) would silently report nothing
+    result = CliRunner().invoke(graph.graph, ["impacted"])
+    assert result.exit_code == 2
+
+    result = CliRunner().invoke(graph.graph, ["impacted", "A...B"])
+    assert result.exit_code == 1
+    assert "DEPENDENCY CYCLE" in result.output
+
+
+def test_impacted_output(tmp_path, monkeypatch, run_git):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    project = tmp_path / "project"
+    manifests = {
+        "mod_a": "{'depends': ['base']}",
+        "mod_b": "{'depends': ['mod_a']}",
+        "mod_c": "{'depends': ['mod_b', 'mod_a']}",
+        "other": "{'depends': ['base']}",
+    }
+    for module, manifest in manifests.items():
+        (project / "src" / module).mkdir(parents=True)
+        (project / "src" / module / "__manifest__.py").write_text(manifest)
+    run_git(project, "init", "-q")
+    run_git(project, "add", ".")
+    run_git(project, "commit", "-q", "-m", "init")
+    (project / "src" / "mod_a" / "models.py").write_text("# changed\n")
+    run_git(project, "add", ".")
+    run_git(project, "commit", "-q", "-m", "change mod_a")
+    monkeypatch.chdir(str(project))
+
+    result = CliRunner().invoke(graph.graph, ["impacted", "HEAD~1..HEAD"])
+    assert result.exit_code == 0
+    assert result.stdout.splitlines() == ["mod_a", "mod_b", "mod_c"]
+
+    result = CliRunner().invoke(graph.graph, ["impacted", "--changed-only", "HEAD~1"])
+    assert result.exit_code == 0
+    assert result.stdout.splitlines() == ["mod_a"]
@@ -0,0 +1,144 @@
+# Copyright 2019 XOE Labs (<https://xoe.solutions>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import json
+
+import pytest
+
+from odooup import _modulegraph
+from odooup._modulegraph import (
+    GRAPH_BACKENDS,
+    _get_manifests_from_git,
+    dump_graph,
+    get_closures,
+    get_cycles,
+    get_graph,
+    get_shortest_path,
+    get_waves,
+    load_graph,
+    topological_sort,
+)
+
+MANIFESTS = {
+    "mod_a": "{'name': 'A', 'depends': ['base']}",
+    "mod_b": "{'name': 'B', 'depends': ['mod_a'], 'auto_install': True}",
+    "mod_c": "{'name': 'C', 'depends': ['mod_a', 'mod_b']}",
+}
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch, run_git):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    project = tmp_path / "project"
+    for module, manifest in MANIFESTS.items():
+        (project / "src" / module).mkdir(parents=True)
+        (project / "src" / module / "__manifest__.py").write_text(manifest)
+    run_git(str(project), "init", "-q")
+    run_git(str(project), "add", ".")
+    run_git(str(project), "commit", "-q", "-m", "init")
+    monkeypatch.chdir(str(project))
+    return project
+
+
+def test_manifests_from_git_batch(project, run_git):
+    objects = [
+        run_git(str(project), "rev-parse", "HEAD:src/{}/__manifest__.py".format(m))
+        for m in sorted(MANIFESTS)
+    ]
+    missing = "0" * 40
+    manifests = _get_manifests_from_git(str(project), objects + [missing])
+    assert [manifests[o] for o in objects] == [MANIFESTS[m] for m in sorted(MANIFESTS)]
+    assert manifests[missing] is None
+
+
+@pytest.mark.parametrize("backend", GRAPH_BACKENDS)
+def test_get_graph(project, backend):
+    if backend == "networkx":
+        pytest.importorskip("networkx")
+    g = get_graph(str(project), backend=backend)
+    assert set(g.predecessors("mod_c")) == {"mod_a", "mod_b"}
+    assert set(g.successors("base")) == {"mod_a"}
+
+
+def test_get_graph_cached(project, monkeypatch):
+    get_graph(str(project))
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("unchanged commits must not be re-scanned")
+
+    monkeypatch.setattr(_modulegraph, "_scan_tree", _fail)
+    monkeypatch.setattr(_modulegraph, "_get_manifests_from_git", _fail)
+    g = get_graph(str(project))
+    assert set(g.predecessors("mod_c")) == {"mod_a", "mod_b"}
+    assert g.nodes["mod_b"]["manifest"]["auto_install"]
+
+
+def test_get_closures(project):
+    closures = get_closures(get_graph(str(project)), ["mod_b", "mod_c"])
+    assert closures["mod_c"].deps == {"base", "mod_a", "mod_b"}
+    assert closures["mod_c"].shortest == ["base", "mod_a", "mod_c"]
+    assert closures["mod_c"].longest == ["base", "mod_a", "mod_b", "mod_c"]
+    assert closures["mod_b"].deps == {"base", "mod_a"}
+
+
+def test_topological_sort(project):
+    g = get_graph(str(project))
+    assert topological_sort(g) == ["base", "mod_a", "mod_b", "mod_c"]
+    assert g.nodes["base"] == {}
+
+
+def test_snapshot_queries(project):
+    g = load_graph(json.loads(json.dumps(dump_graph(get_graph(str(project))))))
+    assert set(g.predecessors("mod_c")) == {"mod_a", "mod_b"}
+    assert g.nodes["mod_b"]["manifest"]["auto_install"]
+    assert get_shortest_path(g, "base", "mod_c") == ["base", "mod_a", "mod_c"]
+    assert get_shortest_path(g, "mod_c", "base") is None
+    assert get_cycles(g) == []
+
+    g.add_module("mod_a", "src", None, {"depends": ["base", "mod_c"]})
+    assert get_cycles(g) == [["mod_a", "mod_b", "mod_c"]]
+
+
+def test_get_waves(project):
+    waves, critical_path = get_waves(get_graph(str(project)))
+    assert waves == [["base"], ["mod_a"], ["mod_b"], ["mod_c"]]
+    assert critical_path == ["base", "mod_a", "mod_b", "mod_c"]
+
+
+def test_get_graph_from_subdirectory(project, tmp_path, monkeypatch, run_git):
+    vendor = tmp_path / "web"
+    (vendor / "web_a").mkdir(parents=True)
+    (vendor / "web_a" / "__manifest__.py").write_text("{'depends': ['mod_a']}")
+    run_git(str(vendor), "init", "-q")
+    run_git(str(vendor), "add", ".")
+    run_git(str(vendor), "commit", "-q", "-m", "init")
+    run_git(
+        str(project),
+        "-c",
+        "protocol.file.allow=always",
+        "submodule",
+        "add",
+        "-q",
+        str(vendor),
+        "vendor/oca/web",
+    )
+    run_git(str(project), "commit", "-q", "-m", "web")
+
+    monkeypatch.chdir(str(project / "src"))
+    g = get_graph(str(project), use_cache=False)
+    assert g.nodes["web_a"]["namespace"] == "vendor/oca/web"
+    assert set(g.successors("mod_a")) == {"mod_b", "mod_c", "web_a"}
+
+
+def test_get_graph_parse_error(project, capsys, run_git):
+    (project / "src" / "broken").mkdir()
+    (project / "src" / "broken" / "__manifest__.py").write_text("{'depends': [")
+    run_git(str(project), "add", ".")
+    run_git(str(project), "commit", "-q", "-m", "broken")
+
+    g = get_graph(str(project), use_cache=False)
+    assert "broken" not in g
+    # Keep stdout clean for the one module per line output of graph queries
+    captured = capsys.readouterr()
+    assert "Error Parsing" in captured.err
+    assert "Error Parsing" not in captured.out
@@ -0,0 +1,179 @@
+# Copyright 2019 XOE Labs (<https://xoe.solutions>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import click
+import pytest
+
+from odooup import _process, patches
+from odooup.patches import Git
+
+REFS = """\
+1111 refs/remotes/dev/HEAD
+2222 refs/remotes/dev/12.0
+3333 refs/remotes/dev/12.0-fix-a
+4444 refs/remotes/dev/12.0-fix-b
+5555 refs/remotes/dev/saas-12.3
+6666 refs/remotes/dev/saas-12.3-fix-c
+7777 refs/remotes/dev/compiled/12.0"""
+
+
+def test_refs_index(monkeypatch):
+    git = Git(".git", "dev", branches=["12.0", "saas-12.3"])
+    calls = []
+
+    def _run(command, worktree=None):
+        calls.append(command)
+        return REFS
+
+    monkeypatch.setattr(git, "run", _run)
+    assert git._get_patches("12.0") == ["dev/12.0-fix-a", "dev/12.0-fix-b"]
+    assert git._get_patches("saas-12.3") == ["dev/saas-12.3-fix-c"]
+    assert git._get_patches("11.0") == []
+    assert git._get_refs()["dev/compiled/12.0"] == "7777"
+    assert "dev/HEAD" not in git._get_refs()
+    assert len(calls) == 1
+
+    git._invalidate_refs()
+    git._get_patches("12.0")
+    assert len(calls) == 2
+
+
+def test_compile_fails_on_commit_tree_error(monkeypatch):
+    git = Git(".git", "dev", branches=["12.0"])
+    outputs = {"for-each-ref": REFS, "merge-tree": "8888", "commit-tree": None}
+    monkeypatch.setattr(git, "run", lambda command, worktree=None: outputs[command[0]])
+    monkeypatch.setattr(git, "push", lambda refspecs: pytest.fail("pushed"))
+
+    with click.Context(click.Command("compile")):
+        with pytest.raises(click.UsageError):
+            git._compile("12.0", ["dev/12.0-fix-a"], "compiled/12.0", "inputs")
+
+
+def test_order_patches(monkeypatch):
+    git = Git(".git", "dev", branches=["12.0"])
+    touched = {
+        "dev/12.0-a": {"web/a.py"},
+        "dev/12.0-b": {"sale/b.py"},
+        "dev/12.0-c": {"web/a.py", "mail/c.py"},
+        "dev/12.0-d": {"mail/c.py"},
+        "dev/12.0-e": {"stock/e.py"},
+    }
+    monkeypatch.setattr(git, "_get_touched_paths", lambda base, br: touched[br])
+
+    ordered, overlaps = git._order_patches("dev/12.0", sorted(touched))
+    assert ordered == [
+        "dev/12.0-b",
+        "dev/12.0-e",
+        "dev/12.0-a",
+        "dev/12.0-c",
+        "dev/12.0-d",
+    ]
+    assert overlaps == {
+        ("dev/12.0-a", "dev/12.0-c"): {"web/a.py"},
+        ("dev/12.0-c", "dev/12.0-d"): {"mail/c.py"},
+    }
+
+
+def test_push(monkeypatch):
+    git = Git(".git", "dev", branches=["12.0"])
+    monkeypatch.setattr(patches, "PUSH_CHUNK_SIZE", 2)
+    outputs = [
+        "To ../remote.git\n"
+        "+\t1111:refs/heads/12.0-a\tabc...def (forced update)\n"
+        "!\t2222:refs/heads/12.0-b\t[remote rejected] (atomic push failed)\n"
+        "Done",
+        # Chunk failing before git reports any ref
+        "",
+    ]
+    calls = []
+
+    def _run(argv, **kwargs):
+        calls.append(argv)
+        return _process.Result(argv, None, 1, outputs[len(calls) - 1], 0)
+
+    monkeypatch.setattr(patches._process, "run", _run)
+    results = git.push(["1111:refs/heads/12.0-a", "2222:refs/heads/12.0-b", "12.0-c"])
+    assert results == {
+        "refs/heads/12.0-a": None,
+        "refs/heads/12.0-b": "[remote rejected] (atomic push failed)",
+        "refs/heads/12.0-c": "not pushed",
+    }
+    assert [argv[-1] for argv in calls] == ["2222:refs/heads/12.0-b", "12.0-c"]
+    assert all("--atomic" in argv for argv in calls)
+
+
+def test_compile_skips_up_to_date(monkeypatch):
+    git = Git(".git", "dev", branches=["12.0"])
+    monkeypatch.setattr(git, "run", lambda command, worktree=None: REFS)
+    inputs = git._get_compile_inputs("dev/12.0", git._get_patches("12.0"))
+    monkeypatch.setattr(git, "_get_compiled_inputs", lambda compiled: inputs)
+    monkeypatch.setattr(
+        git, "_get_touched_paths", lambda base, br: pytest.fail("diffed " + br)
+    )
+    monkeypatch.setattr(git, "_compile", lambda *args: pytest.fail("compiled"))
+
+    git.compile()
+
+
+@pytest.fixture
+def patch_repo(tmp_path, monkeypatch, run_git):
+    # A remote with master, a clean and a conflicting patch branch
+    seed = tmp_path / "seed"
+    seed.mkdir()
+    run_git(seed, "init", "-q", "-b", "master")
+    (seed / "a.txt").write_text("a\n")
+    (seed / "b.txt").write_text("b\n")
+    run_git(seed, "add", ".")
+    run_git(seed, "commit", "-q", "-m", "base")
+    for branch, path in (("master-clean", "b.txt"), ("master-conflict", "a.txt")):
+        run_git(seed, "checkout", "-q", "-b", branch, "master")
+        (seed / path).write_text(branch + "\n")
+        run_git(seed, "commit", "-q", "-am", branch)
+    run_git(seed, "checkout", "-q", "master")
+    (seed / "a.txt").write_text("master\n")
+    run_git(seed, "commit", "-q", "-am", "advance")
+    remote = tmp_path / "remote.git"
+    run_git(tmp_path, "clone", "-q", "--bare", str(seed), str(remote))
+    work = tmp_path / "work"
+    run_git(tmp_path, "clone", "-q", str(remote), str(work))
+    monkeypatch.chdir(str(work))
+    monkeypatch.setattr(click, "confirm", lambda *args, **kwargs: False)
+    return remote, work
+
+
+def test_rebase_patches_in_worktrees(patch_repo, capsys, run_git):
+    remote, work = patch_repo
+    conflicting = run_git(remote, "rev-parse", "master-conflict")
+    git = Git(str(work / ".git"), "origin", branches=["master"])
+
+    git.rebase_patches(jobs=2)
+    output = capsys.readouterr().out
+    assert "REBASE: origin/master-conflict - Conflicts with master" in output
+    assert "master-clean - Conflicts" not in output
+    assert run_git(remote, "merge-base", "master", "master-clean") == run_git(
+        remote, "rev-parse", "master"
+    )
+    assert run_git(remote, "rev-parse", "master-conflict") == conflicting
+    assert len(run_git(work, "worktree", "list").splitlines()) == 1
+    assert run_git(work, "status", "--porcelain") == ""
+
+
+def test_rebase_patches_without_worktrees(patch_repo, monkeypatch, capsys, run_git):
+    remote, work = patch_repo
+    git = Git(str(work / ".git"), "origin", branches=["master"])
+    run = git.run
+
+    def _run(command, worktree=None):
+        if command[:2] == ["worktree", "add"]:  # eg. path exists
+            return None
+        return run(command, worktree)
+
+    monkeypatch.setattr(git, "run", _run)
+
+    git.rebase_patches(jobs=2)
+    output = capsys.readouterr().out
+    assert "Adding worktree" in output
+    assert "rebasing in place" in output
+    assert run_git(remote, "merge-base", "master", "master-clean") == run_git(
+        remote, "rev-parse", "master"
+    )
@@ -0,0 +1,78 @@
+# Copyright 2019 XOE Labs (<https://xoe.solutions>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import subprocess
+import sys
+
+import pytest
+
+from odooup import _process
+
+COUNT = "import time\nfor i in range(1000):\n print(i, flush=True)\n time.sleep(0.01)"
+SLEEP = "import time; time.sleep(10)"
+
+
+@pytest.fixture
+def records():
+    records = []
+    _process.add_listener(records.append)
+    yield records
+    _process.remove_listener(records.append)
+
+
+def test_run(records, tmp_path):
+    argv = [sys.executable, "-c", "print('hello')"]
+    result = _process.run(argv, cwd=str(tmp_path))
+    assert result.output == "hello\n"
+    assert result.returncode == 0
+
+    (record,) = records
+    assert record.argv == argv
+    assert record.cwd == str(tmp_path)
+    assert record.returncode == 0
+    assert record.output_size == len("hello\n")
+    assert 0 <= record.duration < 10
+    assert record.thread == "MainThread"
+
+    with pytest.raises(subprocess.CalledProcessError) as exc:
+        _process.run([sys.executable, "-c", "print('oops'); exit(3)"])
+    assert exc.value.returncode == 3
+    assert exc.value.output == "oops\n"
+    assert records[-1].returncode == 3
+
+
+def test_missing_executable(records):
+    with pytest.raises(subprocess.CalledProcessError) as exc:
+        _process.run(["odooup-no-such-command"])
+    assert exc.value.returncode == 127
+    with pytest.raises(subprocess.CalledProcessError) as exc:
+        next(_process.stream(["odooup-no-such-command"]))
+    assert exc.value.returncode == 127
+    assert [r.returncode for r in records] == [127, 127]
+
+
+def test_timeout(records):
+    with pytest.raises(subprocess.TimeoutExpired):
+        _process.run([sys.executable, "-c", SLEEP], timeout=0.2)
+    with pytest.raises(subprocess.TimeoutExpired):
+        list(_process.stream([sys.executable, "-c", SLEEP], timeout=0.2))
+    assert all(r.duration < 5 for r in records)
+    assert len(records) == 2
+
+
+def test_stream(records):
+    lines = _process.stream([sys.executable, "-c", "print('a'); print('b')"])
+    assert list(lines) == ["a", "b"]
+    assert records[-1].returncode == 0
+    assert records[-1].output_size == 4
+
+
+def test_stream_closed_early_kills(records):
+    lines = _process.stream([sys.executable, "-c", COUNT])
+    assert next(lines) == "0"
+    lines.close()
+
+    (record,) = records
+    # Killed, instead of waited for to print all of its lines
+    assert record.returncode != 0
+    assert record.duration < 5
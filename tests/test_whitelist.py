@@ -0,0 +1,192 @@
+# Copyright 2019 XOE Labs (<https://xoe.solutions>)
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl.html).
+
+import os
+
+import pytest
+
+from odooup._modulegraph import ModuleGraph
+from odooup.whitelist import (
+    DOCKERIGNORE_PLACEHOLDER,
+    _find_sparse_files,
+    _get_affected_src_modules,
+    _get_cone_patterns,
+    _get_manifest_state,
+    _is_cone_compatible,
+    _reconcile_auto_install,
+    ensure_dockerignore_updated,
+    ensure_sparse_checkouts,
+)
+
+
+def _add_module(g, name, namespace, depends=(), auto_install=False):
+    manifest = {"depends": list(depends), "auto_install": auto_install}
+    g.add_module(name, str(namespace), None, manifest)
+
+
+def test_reconcile_auto_install_chain(tmp_path):
+    ns = tmp_path / "web"
+    ns.mkdir()
+    (tmp_path / ".sparse-web").write_text("web_a\n!setup/**\n")
+    g = ModuleGraph()
+    _add_module(g, "base", tmp_path / "odoo")
+    _add_module(g, "web_a", ns, ["base"])
+    _add_module(g, "web_b", ns, ["base"])
+    _add_module(g, "glue_a", ns, ["web_a", "base"], auto_install=True)
+    _add_module(g, "glue_ab", ns, ["glue_a", "web_b"], auto_install=True)
+    _add_module(g, "glue_aa", ns, ["glue_a"], auto_install=True)
+
+    added = _reconcile_auto_install(g)
+    assert set(added) == {"glue_a", "glue_aa"}
+    assert (tmp_path / ".sparse-web").read_text().splitlines() == [
+        "glue_a",
+        "glue_aa",
+        "web_a",
+        "!setup/**",
+    ]
+
+
+def test_cone_patterns():
+    assert _get_cone_patterns({"odoo/addons": {"web", "base"}}) == [
+        "/*",
+        "!/*/",
+        "/odoo/",
+        "!/odoo/*/",
+        "/odoo/addons/",
+        "!/odoo/addons/*/",
+        "/odoo/addons/base/",
+        "/odoo/addons/web/",
+    ]
+    # All namespaces of a repo share its sparse checkout
+    assert _get_cone_patterns({"addons": {"sale"}, "odoo/addons": {"web"}}) == [
+        "/*",
+        "!/*/",
+        "/addons/",
+        "!/addons/*/",
+        "/addons/sale/",
+        "/odoo/",
+        "!/odoo/*/",
+        "/odoo/addons/",
+        "!/odoo/addons/*/",
+        "/odoo/addons/web/",
+    ]
+    assert _is_cone_compatible({"web_a", "!setup/**"})
+    assert not _is_cone_compatible({"web_a", "web_b/static/**"})
+
+
+def test_affected_src_modules():
+    def _get_graph(web_a=True):
+        g = ModuleGraph()
+        g.add_module("base", "vendor/odoo/cc", "b0", {})
+        if web_a:
+            g.add_module("web_a", "vendor/oca/web", "a0", {"depends": ["base"]})
+        g.add_module("web_b", "vendor/oca/web", "b1", {"depends": ["base"]})
+        g.add_module("my_mod", "src", "m0", {"depends": ["web_a"]})
+        g.add_module("other", "src", "o0", {"depends": ["web_b"]})
+        return g
+
+    state = {"manifests": _get_manifest_state(_get_graph())}
+    assert _get_affected_src_modules(_get_graph(), state) == set()
+
+    g = _get_graph()
+    g.add_module("web_b", "vendor/oca/web", "b2", {"depends": ["base"]})
+    assert _get_affected_src_modules(g, state) == {"other"}
+
+    # Removed, web_a remains as dependency of my_mod only
+    assert _get_affected_src_modules(_get_graph(web_a=False), state) == {"my_mod"}
+
+
+MODULES = ("odoo/addons/web", "odoo/addons/mail", "addons/sale", "addons/crm")
+
+
+@pytest.fixture
+def odoo_submodule(tmp_path, monkeypatch, run_git):
+    # A project with odoo (namespaces addons/ and odoo/addons/) as submodule
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    odoo = tmp_path / "odoo"
+    for module in MODULES:
+        (odoo / module).mkdir(parents=True)
+        (odoo / module / "__manifest__.py").write_text("{'depends': []}")
+    run_git(odoo, "init", "-q")
+    run_git(odoo, "add", ".")
+    run_git(odoo, "commit", "-q", "-m", "init")
+    project = tmp_path / "project"
+    project.mkdir()
+    run_git(project, "init", "-q")
+    run_git(
+        project,
+        "-c",
+        "protocol.file.allow=always",
+        "submodule",
+        "add",
+        "-q",
+        str(odoo),
+        "vendor/odoo/cc",
+    )
+    run_git(project, "commit", "-q", "-m", "odoo")
+    return project / "vendor" / "odoo" / "cc"
+
+
+def test_ensure_sparse_checkouts(odoo_submodule):
+    cc = odoo_submodule
+    project = cc.parent.parent.parent
+    # A namespace nested within the submodule
+    (cc / "odoo" / ".sparse-addons").write_text("web\n")
+
+    sparse_file = str(cc / "odoo" / ".sparse-addons")
+    assert _find_sparse_files(str(project)) == [sparse_file]
+
+    ensure_sparse_checkouts(str(project))
+    assert (cc / "odoo" / "addons" / "web").is_dir()
+    assert not (cc / "odoo" / "addons" / "mail").exists()
+
+
+def test_ensure_cone_sparse_checkouts(odoo_submodule):
+    cc = odoo_submodule
+    project = cc.parent.parent.parent
+    (cc / ".sparse-addons").write_text("sale\n!setup/**\n")
+    ensure_sparse_checkouts(str(project), cone=True)
+    assert (cc / "addons" / "sale").is_dir()
+    assert not (cc / "odoo" / "addons").exists()
+
+    # The namespace odoo/addons is missing from the checkout by now
+    (cc / "odoo").mkdir(exist_ok=True)
+    (cc / "odoo" / ".sparse-addons").write_text("web\n")
+    ensure_sparse_checkouts(str(project), cone=True)
+    assert (cc / "addons" / "sale").is_dir()
+    assert (cc / "odoo" / "addons" / "web").is_dir()
+    assert not (cc / "addons" / "crm").exists()
+    assert not (cc / "odoo" / "addons" / "mail").exists()
+
+
+def test_ensure_dockerignore_updated(tmp_path, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    (tmp_path / "vendor" / "oca" / "web").mkdir(parents=True)
+    (tmp_path / "vendor" / "oca" / ".sparse-web").write_text("web_a\n!setup/**\n")
+    dockerignore = tmp_path / ".dockerignore"
+    dockerignore.write_text("# header\n" + DOCKERIGNORE_PLACEHOLDER + "\nstale\n")
+    os.chmod(str(dockerignore), 0o640)
+    g = ModuleGraph()
+    g.add_module("web_a", "vendor/oca/web", None, {})
+    g.add_module("web_b", "vendor/oca/web", None, {})
+
+    assert ensure_dockerignore_updated(g)
+    assert dockerignore.read_text().splitlines()[2:] == [
+        "vendor/oca/web/**",
+        "!vendor/oca/web/web_a",
+    ]
+    os.utime(str(dockerignore), (1, 1))
+    assert not ensure_dockerignore_updated(g)
+    assert dockerignore.stat().st_mtime == 1
+
+    # Replaced (by rename), not rewritten in place
+    inode = dockerignore.stat().st_ino
+    (tmp_path / "vendor" / "oca" / ".sparse-web").write_text("web_b\n")
+    assert ensure_dockerignore_updated(g, compact=True)
+    assert dockerignore.read_text().splitlines()[2:] == [
+        "vendor/oca/web/web_a",
+        "vendor/oca/web/setup",
+    ]
+    assert dockerignore.stat().st_ino != inode
+    assert dockerignore.stat().st_mode & 0o777 == 0o640
+    assert sorted(os.listdir(str(tmp_path))) == [".dockerignore", "vendor"]